@@ -0,0 +1,70 @@
+"""
+Compare the old per-row DateTime conversion of get_stock_df with the vectorized one.
+
+Run from the repository root: python benchmarks/bench_timestamps.py [rows ...]
+"""
+
+# Standard library imports.
+import os
+import sys
+import timeit
+from datetime import datetime
+
+# Third party imports.
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stocks  # noqa: E402
+
+
+def _create_chart_data(rows: int) -> list:
+    """Create GetChartData style [epoch milliseconds, price] rows, one per minute."""
+
+    start = int(datetime(2015, 1, 1).timestamp()) * 1000
+    timestamps = start + np.arange(rows, dtype=np.int64) * 60_000
+    prices = np.round(np.random.default_rng(0).uniform(1, 100, rows), 2)
+
+    return [[int(t), float(p)] for t, p in zip(timestamps, prices)]
+
+
+def _convert_per_row(chart_data: list) -> pd.DataFrame:
+    """The conversion get_stock_df used before vectorizing it."""
+
+    pd_stock_value = pd.DataFrame(chart_data, columns=['Timestamp', 'Value'])
+
+    timestamps = pd_stock_value['Timestamp'].values // 1000
+    pd_stock_value.loc[:, 'Timestamp'] = timestamps
+    timestamps_dt = [datetime.fromtimestamp(x) for x in timestamps]
+    pd_stock_value['DateTime'] = pd.to_datetime(timestamps_dt)
+
+    return pd_stock_value
+
+
+def _convert_vectorized(chart_data: list) -> pd.DataFrame:
+    json_result = {
+        '@status': '1',
+        'data'   : [{'instData': {'@nm': 'BENCH', '@fnm': 'Benchmark Oyj'},
+                     'chartData': {'cp': chart_data}}]
+    }
+    return stocks._parse_stock_history_response(json_result, 'HEXBENCH', 'Europe/Helsinki')['Value']
+
+
+def main(row_counts: [int]):
+    print(f'{"rows":>10} {"per row (s)":>12} {"vectorized (s)":>15} {"speedup":>8}')
+
+    for rows in row_counts:
+        chart_data = _create_chart_data(rows)
+        repeat = max(1, 100_000 // rows)
+
+        per_row = min(timeit.repeat(lambda: _convert_per_row(chart_data), number=repeat,
+                                    repeat=3)) / repeat
+        vectorized = min(timeit.repeat(lambda: _convert_vectorized(chart_data), number=repeat,
+                                       repeat=3)) / repeat
+
+        print(f'{rows:>10} {per_row:>12.5f} {vectorized:>15.5f} {per_row / vectorized:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [1_000, 10_000, 100_000, 1_000_000])
@@ -0,0 +1,98 @@
+"""
+DataFeedProxy response fixtures for the benchmarks.
+
+The fixtures are stored in benchmarks/fixtures: market.xml is a GetMarket response listing the
+instruments of every market, chart.json is a GetChartData response with the price history of one
+instrument. Missing fixtures are generated with fixed seeds, so every run and every commit is
+measured against the same data. Replace the files with recorded API responses to benchmark against
+real data.
+"""
+
+# Standard library imports.
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+# Third party imports.
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import stocks  # noqa: E402
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Sizes of the generated fixtures, roughly those of the real Nordic markets and a few years of
+# minute level prices.
+INSTRUMENTS_PER_MARKET = 200
+CHART_START = datetime(2015, 1, 1, tzinfo=timezone.utc)
+CHART_ROWS = 500_000
+CHART_STEP = timedelta(minutes=5)
+
+_WORDS = ['Nordic', 'Bank', 'Energy', 'Paper', 'Steel', 'Telecom', 'Shipping', 'Pharma', 'Forest',
+          'Mining', 'Retail', 'Insurance', 'Capital', 'Systems', 'Foods', 'Motors', 'Invest']
+_SUFFIXES = ['Oyj', 'AB', 'A/S', 'ASA', 'Holding', 'Group']
+
+
+def create_market_xml(instruments_per_market=INSTRUMENTS_PER_MARKET) -> bytes:
+    """Create a GetMarket response listing instruments of every market in stocks.Markets."""
+
+    rng = np.random.default_rng(0)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?><response><markets>']
+
+    for market in stocks.Markets:
+        code = market.value[-4:]
+        parts.append(f'<market id="{market.value}" nm="{market.name}"><instruments>')
+
+        for i in range(instruments_per_market):
+            words = rng.choice(_WORDS, size=rng.integers(1, 4), replace=False)
+            full_name = ' '.join(words) + ' ' + rng.choice(_SUFFIXES)
+            name = ''.join(x[:2] for x in words).upper() + str(i)
+            price = rng.uniform(0.5, 200)
+            parts.append(f'<inst id="HEX{code}{i:04d}" nm="{name}" fnm="{full_name}" '
+                         f'bp="{price:.2f}" ap="{price * 1.001:.2f}" lp="{price:.2f}" '
+                         f'tv="{rng.integers(0, 10 ** 7)}"/>')
+
+        parts.append('</instruments></market>')
+
+    parts.append('</markets></response>')
+    return ''.join(parts).encode()
+
+
+def create_chart_json(rows=CHART_ROWS) -> bytes:
+    """Create a GetChartData response with a random walk price history of one instrument."""
+
+    rng = np.random.default_rng(1)
+    start = int(CHART_START.timestamp()) * 1000
+    timestamps = start + np.arange(rows, dtype=np.int64) * int(CHART_STEP.total_seconds() * 1000)
+    prices = np.round(np.abs(50 + np.cumsum(rng.normal(0, 0.1, rows))), 2)
+
+    return json.dumps({
+        '@status': '1',
+        'data'   : [{
+            'instData' : {'@id': 'HEXBENCH', '@nm': 'BENCH', '@fnm': 'Benchmark Oyj'},
+            'chartData': {'cp': [[int(t), float(p)] for t, p in zip(timestamps, prices)]}
+        }]
+    }).encode()
+
+
+def load_fixture(name: str, create) -> bytes:
+    """Read a fixture file, creating it first if it doesn't exist."""
+
+    path = os.path.join(FIXTURE_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(FIXTURE_DIR, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(create())
+
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def load_market_xml() -> bytes:
+    return load_fixture('market.xml', create_market_xml)
+
+
+def load_chart_json() -> bytes:
+    return load_fixture('chart.json', create_chart_json)
@@ -0,0 +1,165 @@
+"""
+Local stand-in for the DataFeedProxy endpoint, serving the benchmark fixtures.
+
+GetMarket queries get the requested markets of market.xml. GetChartData queries get the rows of
+chart.json in the requested date range, repeated for every requested instrument. The dates are
+days of the exchange timezone, as stocks.py assumes. Responses are
+cached by query, so only the first request of a query pays for building it.
+
+The server runs in its own process so that it doesn't compete for the GIL with the code being
+measured. Run it standalone with: python benchmarks/replay_server.py [port]
+"""
+
+# Standard library imports.
+import json
+import multiprocessing
+import os
+import sys
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from zoneinfo import ZoneInfo
+
+# Third party imports.
+import numpy as np
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures  # noqa: E402
+
+# Path of the endpoint, as in the real API url.
+_ENDPOINT_PATH = '/webproxy/DataFeedProxy.aspx'
+
+# Timezone of the days of the FromDate and ToDate parameters.
+_EXCHANGE_TIMEZONE = ZoneInfo('Europe/Helsinki')
+
+
+class _Responses:
+    """Builds and caches the responses to fixture queries."""
+
+    def __init__(self):
+        markets = etree.fromstring(fixtures.load_market_xml()).iter('market')
+        self._markets = {x.attrib['id']: etree.tostring(x) for x in markets}
+
+        chart = json.loads(fixtures.load_chart_json())
+        entry = chart['data'][0]
+        self._inst_data = entry['instData']
+        self._prices = np.asarray(entry['chartData']['cp'], dtype=np.float64).reshape(-1, 2)
+
+        self._cache = {}
+
+    def get(self, query: str) -> (bytes, str):
+        """Get the response body and content type of a query string."""
+
+        if query not in self._cache:
+            params = {key: value[0] for key, value in parse_qs(query).items()}
+            if params.get('Action') == 'GetMarket':
+                self._cache[query] = self._get_market(params['Market'].split(',')), 'text/xml'
+            else:
+                self._cache[query] = self._get_chart_data(
+                    params['Instrument'].split(','), params['FromDate'], params['ToDate']), \
+                    'application/json'
+
+        return self._cache[query]
+
+    def _get_market(self, market_ids: [str]) -> bytes:
+        markets = b''.join(self._markets[x] for x in market_ids if x in self._markets)
+        return b'<?xml version="1.0" encoding="UTF-8"?><response><markets>' + markets + \
+            b'</markets></response>'
+
+    def _get_chart_data(self, instrument_ids: [str], start_date: str, end_date: str) -> bytes:
+        start = datetime.combine(date.fromisoformat(start_date), datetime.min.time(),
+                                 _EXCHANGE_TIMEZONE)
+        end = datetime.combine(date.fromisoformat(end_date) + timedelta(days=1),
+                               datetime.min.time(), _EXCHANGE_TIMEZONE)
+
+        timestamps = self._prices[:, 0]
+        rows = self._prices[(timestamps >= start.timestamp() * 1000) &
+                            (timestamps < end.timestamp() * 1000)]
+        cp = [[int(t), p] for t, p in rows.tolist()]
+
+        return json.dumps({
+            '@status': '1',
+            'data'   : [{'instData': {**self._inst_data, '@id': x}, 'chartData': {'cp': cp}}
+                        for x in instrument_ids]
+        }).encode()
+
+
+def _create_handler(responses: _Responses):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != _ENDPOINT_PATH:
+                self.send_error(404)
+                return
+
+            body, content_type = responses.get(url.query)
+
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=0, port_queue: multiprocessing.Queue = None):
+    """Serve the fixtures until interrupted, putting the bound port to the queue if given."""
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), _create_handler(_Responses()))
+    if port_queue is not None:
+        port_queue.put(server.server_port)
+    else:
+        print(f'Serving on http://127.0.0.1:{server.server_port}{_ENDPOINT_PATH}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class ReplayServer:
+    """Runs the replay server in a child process, use as a context manager."""
+
+    def __init__(self):
+        self.url = None
+        self._process = None
+
+    def start(self) -> str:
+        """Start the server and return its endpoint url."""
+
+        # Create the fixtures before the child process starts, so that it doesn't count towards
+        # the startup timeout.
+        fixtures.load_market_xml()
+        fixtures.load_chart_json()
+
+        port_queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=serve, args=(0, port_queue), daemon=True)
+        self._process.start()
+
+        self.url = f'http://127.0.0.1:{port_queue.get(timeout=60)}{_ENDPOINT_PATH}'
+        return self.url
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
@@ -0,0 +1,366 @@
+"""
+Benchmark the hot paths of stocks.py against the local replay server.
+
+Results are stored as JSON in benchmarks/results, named by the git commit they were measured at,
+so that runs on different commits can be compared:
+
+    python benchmarks/run.py                     # Run all benchmarks and store the results.
+    python benchmarks/run.py -k stock_df         # Run the benchmarks whose name contains stock_df.
+    python benchmarks/run.py --compare 1a2b3c4   # Compare with the results of another commit.
+
+Only compare results measured on the same machine.
+"""
+
+# Standard library imports.
+import argparse
+import contextlib
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from datetime import date, datetime
+
+# Third party imports.
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures  # noqa: E402
+import stocks  # noqa: E402
+from replay_server import ReplayServer  # noqa: E402
+
+_REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# Date range of the history queries, about a year of the chart fixture.
+_HISTORY_START = date(2016, 1, 1)
+_HISTORY_END = date(2016, 12, 31)
+
+# Instruments of the price panel benchmark, every one gets the history of the chart fixture.
+_PANEL_INSTRUMENTS = [f'HEXBENCH{i}' for i in range(10)]
+
+# Patterns of the instrument filtering benchmarks.
+_FILTER_PATTERNS = ['bank', 'oyj', 'energy paper', 'NOBA', 'holding', 'x', 'steel', 'telecom a',
+                    'ship', 'pharma', 'fores', 'mining', 'retail', 'insur', 'capital', 'systems ab',
+                    'foods', 'motors', 'invest', 'nordic', 'group', 'asa', 'a/s', 'zzz']
+
+# Registered benchmarks, in the order they are run.
+_BENCHMARKS = {}
+
+
+def benchmark(fn):
+    """
+    Register a benchmark.
+
+    The function gets the benchmark context and yields the callable to time, or None to skip the
+    benchmark. Code before and after the yield is setup and teardown that isn't timed.
+    """
+
+    _BENCHMARKS[fn.__name__] = contextlib.contextmanager(fn)
+    return fn
+
+
+class _Context:
+    """State shared by the benchmarks."""
+
+    def __init__(self, url: str, work_dir: str):
+        self.client = stocks.DataFeedClient(api_url=url)
+        self.work_dir = work_dir
+        self.market_xml = fixtures.load_market_xml()
+        self.chart_json = fixtures.load_chart_json()
+        self.instruments = stocks._parse_stock_instruments_response(
+            self.market_xml).to_instruments()
+
+    def create_cache_dir(self, name: str) -> str:
+        cache_dir = os.path.join(self.work_dir, name)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return cache_dir
+
+
+@contextlib.contextmanager
+def _memory_cache_disabled():
+    memory_cache = stocks.get_memory_cache()
+    stocks.set_memory_cache(None)
+    try:
+        yield
+    finally:
+        stocks.set_memory_cache(memory_cache)
+
+
+@benchmark
+def fetch_stock_page(context: _Context):
+    yield lambda: stocks._fetch_stock_page(*stocks.Markets, client=context.client).content
+
+
+@benchmark
+def parse_stock_instruments(context: _Context):
+    yield lambda: stocks._parse_stock_instruments_response(context.market_xml)
+
+
+@benchmark
+def get_market_instruments_miss(context: _Context):
+    yield lambda: stocks.get_market_instruments(list(stocks.Markets), load_from_cache=False,
+                                                save_to_cache=False, client=context.client)
+
+
+@benchmark
+def get_market_instruments_disk_hit(context: _Context):
+    cache_dir = context.create_cache_dir('market_instruments')
+    stocks.get_market_instruments(list(stocks.Markets), cache_dir=cache_dir,
+                                  client=context.client)
+
+    with _memory_cache_disabled():
+        yield lambda: stocks.get_market_instruments(list(stocks.Markets), cache_dir=cache_dir,
+                                                    client=context.client)
+
+
+@benchmark
+def get_market_instruments_frame(context: _Context):
+    cache_dir = context.create_cache_dir('market_instruments_frame')
+    stocks.get_market_instruments(list(stocks.Markets), cache_dir=cache_dir,
+                                  client=context.client)
+
+    with _memory_cache_disabled():
+        yield lambda: stocks.get_market_instruments(list(stocks.Markets), cache_dir=cache_dir,
+                                                    return_format='frame', client=context.client)
+
+
+@benchmark
+def filter_market_instruments(context: _Context):
+    yield lambda: [stocks.filter_market_instruments(context.instruments, x)
+                   for x in _FILTER_PATTERNS]
+
+
+@benchmark
+def filter_market_instruments_many(context: _Context):
+    yield lambda: stocks.filter_market_instruments_many(context.instruments, _FILTER_PATTERNS)
+
+
+@benchmark
+def instrument_index_keystrokes(context: _Context):
+    # Every prefix of the query, as typed into a search box.
+    index = stocks.InstrumentIndex(context.instruments)
+    queries = ['nordic steel'[:i] for i in range(1, 13)]
+
+    yield lambda: [(index.search(x, 'substring'), index.search(x, 'fuzzy')) for x in queries]
+
+
+@benchmark
+def decode_stock_history(context: _Context):
+    yield lambda: stocks._decode_chart_data_response([context.chart_json])
+
+
+@benchmark
+def stock_frame_construction(context: _Context):
+    json_result = stocks._decode_chart_data_response([context.chart_json])
+
+    yield lambda: stocks._parse_stock_history_response(json_result, 'HEXBENCH',
+                                                       stocks._DEFAULT_TIMEZONE)
+
+
+@benchmark
+def get_stock_df_miss(context: _Context):
+    yield lambda: stocks.get_stock_df('HEXBENCH', _HISTORY_START, _HISTORY_END,
+                                      load_from_cache=False, save_to_cache=False,
+                                      client=context.client)
+
+
+def _get_stock_df_disk_hit(context: _Context, cache_backend):
+    cache_dir = context.create_cache_dir(f'history_{cache_backend.extension}')
+    stocks.get_stock_df('HEXBENCH', _HISTORY_START, _HISTORY_END, cache_dir=cache_dir,
+                        client=context.client, cache_backend=cache_backend)
+
+    with _memory_cache_disabled():
+        yield lambda: stocks.get_stock_df('HEXBENCH', _HISTORY_START, _HISTORY_END,
+                                          cache_dir=cache_dir, client=context.client,
+                                          cache_backend=cache_backend)
+
+
+@benchmark
+def get_stock_df_disk_hit_pickle(context: _Context):
+    yield from _get_stock_df_disk_hit(context, stocks.PickleCacheBackend())
+
+
+@benchmark
+def get_stock_df_disk_hit_arrays(context: _Context):
+    yield from _get_stock_df_disk_hit(context, stocks.MemoryMappedCacheBackend())
+
+
+@benchmark
+def get_stock_df_disk_hit_parquet(context: _Context):
+    if stocks.pyarrow is None:
+        yield None
+        return
+    yield from _get_stock_df_disk_hit(context, stocks.ParquetCacheBackend())
+
+
+@benchmark
+def get_stock_df_disk_hit_feather(context: _Context):
+    if stocks.pyarrow is None:
+        yield None
+        return
+    yield from _get_stock_df_disk_hit(context, stocks.FeatherCacheBackend())
+
+
+@benchmark
+def get_stock_df_memory_hit(context: _Context):
+    cache_dir = context.create_cache_dir('history_memory')
+    stocks.get_stock_df('HEXBENCH', _HISTORY_START, _HISTORY_END, cache_dir=cache_dir,
+                        client=context.client)
+
+    yield lambda: stocks.get_stock_df('HEXBENCH', _HISTORY_START, _HISTORY_END,
+                                      cache_dir=cache_dir, client=context.client)
+
+
+@benchmark
+def get_price_panel(context: _Context):
+    cache_dir = context.create_cache_dir('price_panel')
+    stocks.get_stock_dfs(_PANEL_INSTRUMENTS, _HISTORY_START, _HISTORY_END, cache_dir=cache_dir,
+                         client=context.client)
+
+    yield lambda: stocks.get_price_panel(_PANEL_INSTRUMENTS, _HISTORY_START, _HISTORY_END,
+                                         cache_dir=cache_dir, client=context.client)
+
+
+def _time(fn, repeat: int, min_time: float) -> dict:
+    """Time a callable, calling it enough times per repeat to take at least min_time seconds."""
+
+    # Warm up, which also fills the response cache of the replay server.
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+
+    number = max(1, int(min_time / max(elapsed, 1e-9)))
+    times = [x / number for x in timeit.repeat(fn, number=number, repeat=repeat)]
+
+    return {'min': min(times), 'median': statistics.median(times), 'number': number,
+            'repeat': repeat}
+
+
+def _get_commit() -> str:
+    """Get the short hash of the checked out commit, marked dirty if tracked files are modified."""
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                cwd=_REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return f'{commit}-dirty' if status else commit
+
+
+def _load_results(reference: str) -> dict:
+    """Load results from a file path, or the stored results of a commit."""
+
+    if not os.path.exists(reference):
+        matches = sorted(glob.glob(os.path.join(_RESULTS_DIR, f'{reference}*.json')))
+        if not matches:
+            raise SystemExit(f'No stored results found for {reference}')
+        reference = matches[0]
+
+    with open(reference) as f:
+        return json.load(f)
+
+
+def _format_time(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def _compare(results: dict, base: dict, threshold: float) -> [str]:
+    """Print the results next to the base results, return the names of the regressed benchmarks."""
+
+    print(f'\nCompared with {base["commit"]} ({base["date"]}):')
+    print(f'{"benchmark":<36} {"base":>10} {"current":>10} {"change":>8}')
+
+    regressions = []
+    for name, timing in results['benchmarks'].items():
+        if name not in base['benchmarks']:
+            continue
+
+        base_time = base['benchmarks'][name]['min']
+        change = timing['min'] / base_time - 1
+        marker = ''
+        if change > threshold:
+            marker = '  slower'
+            regressions.append(name)
+        elif change < -threshold:
+            marker = '  faster'
+
+        print(f'{name:<36} {_format_time(base_time):>10} {_format_time(timing["min"]):>10} '
+              f'{change:>+8.1%}{marker}')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-k', dest='filter', help='run only benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='timing repeats per benchmark')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum time of one repeat in seconds')
+    parser.add_argument('--output', help='results file, defaults to results/<commit>.json')
+    parser.add_argument('--no-save', action='store_true', help="don't store the results")
+    parser.add_argument('--compare', help='results file or commit to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    names = [x for x in _BENCHMARKS if args.filter is None or args.filter in x]
+    commit = _get_commit()
+    results = {
+        'commit'    : commit,
+        'date'      : datetime.now().isoformat(timespec='seconds'),
+        'python'    : platform.python_version(),
+        'numpy'     : np.__version__,
+        'pandas'    : pd.__version__,
+        'machine'   : platform.node(),
+        'benchmarks': {}
+    }
+
+    print(f'{"benchmark":<36} {"min":>10} {"median":>10}')
+
+    with ReplayServer() as server, tempfile.TemporaryDirectory() as work_dir:
+        context = _Context(server.url, work_dir)
+
+        for name in names:
+            with _BENCHMARKS[name](context) as fn:
+                if fn is None:
+                    print(f'{name:<36} {"skipped":>10}')
+                    continue
+
+                timing = _time(fn, args.repeat, args.min_time)
+
+            results['benchmarks'][name] = timing
+            print(f'{name:<36} {_format_time(timing["min"]):>10} '
+                  f'{_format_time(timing["median"]):>10}')
+
+    if not args.no_save:
+        output = args.output or os.path.join(_RESULTS_DIR, f'{commit}.json')
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nResults stored to {output}')
+
+    if args.compare:
+        regressions = _compare(results, _load_results(args.compare), args.threshold)
+        if regressions:
+            raise SystemExit(f'\n{len(regressions)} benchmarks regressed')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,60 @@
 # Standard library imports.
+import asyncio
+import bisect
+import contextlib
+import functools
+import json
 import logging
 import os
 import pickle
-from datetime import datetime
+import re
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from enum import Enum
 
+# File locking is only available on Unix.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # Third party imports.
-import bs4
 import dateutil
+import numpy as np
 import pandas as pd
 import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Optional third party imports.
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.dataset
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 # Default cache file directory. Will be created if does not exists and caches are used.
 _DEFAULT_CACHE_DIR = 'cache'
@@ -20,6 +65,22 @@ _log = logging.getLogger(__name__)
 # Urls for Nasdaq XML API endpoints.
 _API_URL = 'http://www.nasdaqomxnordic.com/webproxy/DataFeedProxy.aspx'
 
+# Timezone of the DateTime column of price histories.
+_DEFAULT_TIMEZONE = 'Europe/Helsinki'
+
+# Timezone of the days of the API date range parameters. Query date ranges and cache coverage use
+# these days whatever the timezone of the DateTime column is, so results don't depend on it.
+_EXCHANGE_TIMEZONE = 'Europe/Helsinki'
+
+# Default HTTP client settings, (connect, read) timeout is in seconds.
+_DEFAULT_TIMEOUT = (5, 30)
+_DEFAULT_POOL_SIZE = 10
+_DEFAULT_MAX_RETRIES = 3
+_DEFAULT_BACKOFF_FACTOR = 0.5
+
+# Size of the response chunks fed to the streaming parsers, in bytes.
+_CHUNK_SIZE = 64 * 1024
+
 
 class Markets(Enum):
     """Enum containing the available markets."""
@@ -48,42 +109,676 @@ class Markets(Enum):
 class MarketInstrument:
     """Represents a market instrument that prices can be queried for."""
 
+    __slots__ = ('id', 'name', 'full_name', 'market', 'bid_price', 'ask_price', 'last_price',
+                 'total_volume')
+
+    _FLOAT_PROPERTIES = frozenset(['ask_price', 'bid_price', 'last_price', 'total_volume'])
+
     @classmethod
     def from_json_result(cls, result):
-        instance = cls()
+        float_properties = [x for x in result if x in cls._FLOAT_PROPERTIES]
+        float_values = _parse_numeric_column([result[x] for x in float_properties]).tolist()
+
+        return cls(**{**result, **dict(zip(float_properties, float_values))})
+
+    def __init__(self, id=None, name=None, full_name=None, market=None, bid_price=None,
+                 ask_price=None, last_price=None, total_volume=None):
+        self.id = id
+        self.name = name
+        self.full_name = full_name
+        self.market = market
+        self.bid_price = bid_price
+        self.ask_price = ask_price
+        self.last_price = last_price
+        self.total_volume = total_volume
+
+    def __repr__(self) -> str:
+        """Return a readable representation of the instrument."""
+        property_strings = [f'{x}:{getattr(self, x, None)}' for x in sorted(self.__slots__)]
+        return ', '.join(property_strings)
+
 
-        float_properties = ['ask_price', 'bid_price', 'last_price', 'total_volume']
+def _parse_numeric_column(values) -> np.ndarray:
+    """
+    Convert a column of instrument attribute values to float64 in bulk.
+
+    Missing, empty and unparseable values become NaN. Locale formatted numbers are accepted, with
+    spaces or apostrophes as thousands separators and a decimal comma, e.g. '1 234,50'. When a
+    value has both commas and dots, the last one of them is the decimal separator.
+    """
 
-        for key, value in result.items():
-            setattr(instance, key, float(value) if key in float_properties else value)
+    values = pd.Series(values, dtype=object)
+    numbers = pd.to_numeric(values, errors='coerce')
 
-        return instance
+    # Retry the values that are neither numbers nor empty as locale formatted numbers.
+    retry = numbers.isna() & values.notna() & (values != '')
+    if retry.any():
+        strings = values[retry].astype(str).str.replace("[\\s'\u00a0\u202f]", '', regex=True)
+        last_comma = strings.str.rfind(',')
+        last_dot = strings.str.rfind('.')
+        decimal_comma = (last_comma > last_dot) & ((last_dot >= 0) | (strings.str.count(',') == 1))
 
-    def __init__(self):
-        self.id = None
-        self.name = None
-        self.full_name = None
-        self.market = None
-        self.bid_price = None
-        self.ask_price = None
-        self.last_price = None
-        self.total_volume = None
+        strings = strings.where(~decimal_comma, strings.str.replace('.', '', regex=False)
+                                .str.replace(',', '.', regex=False))
+        strings = strings.where(decimal_comma, strings.str.replace(',', '', regex=False))
+        numbers[retry] = pd.to_numeric(strings, errors='coerce')
+
+    return numbers.to_numpy(dtype=np.float64)
+
+
+class InstrumentTable:
+    """
+    Columnar table of market instruments.
+
+    Every property of MarketInstrument is stored as one NumPy array, string properties as object
+    arrays and prices and volume as float64 arrays, so no object is kept per instrument.
+    Indexing with a position returns a MarketInstrument, indexing with a property name returns its
+    column.
+
+    The attribute values the prices and volume were parsed from are kept in raw_columns, when
+    known, and returned by to_dicts.
+    """
+
+    STRING_COLUMNS = ('id', 'name', 'full_name', 'market')
+    FLOAT_COLUMNS = ('bid_price', 'ask_price', 'last_price', 'total_volume')
+
+    @classmethod
+    def from_json_results(cls, results: [dict]):
+        """Create the table from instrument dicts, prices and volumes may be numbers or strings."""
+
+        columns = {}
+        raw_columns = {}
+
+        for column in cls.STRING_COLUMNS:
+            columns[column] = np.array([x[column] for x in results], dtype=object)
+
+        for column in cls.FLOAT_COLUMNS:
+            raw_columns[column] = np.array([x.get(column) for x in results], dtype=object)
+            columns[column] = _parse_numeric_column(raw_columns[column])
+
+        return cls(columns, raw_columns)
+
+    def __init__(self, columns: dict, raw_columns: dict = None):
+        self.columns = columns
+        self.raw_columns = raw_columns
+        self._index = None
+
+    def __len__(self) -> int:
+        return len(self.columns['id'])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+
+        return MarketInstrument(**{column: values[key].item() if column in self.FLOAT_COLUMNS
+                                   else values[key] for column, values in self.columns.items()})
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
     def __repr__(self) -> str:
-        """Return a readable representation of the instrument."""
-        properties = [x for x in dir(self) if
-                      not x.startswith('_') and not callable(getattr(self, x))]
-        property_strings = [f'{x}:{getattr(self, x, None)}' for x in properties]
-        return ', '.join(property_strings)
+        return f'InstrumentTable({len(self)} instruments)'
+
+    @property
+    def index(self):
+        """Search index over the instrument names, built on first use."""
+
+        if self._index is None:
+            self._index = InstrumentIndex(self)
+        return self._index
+
+    def select(self, rows):
+        """Return a table of the rows selected with a boolean mask or an array of positions."""
+
+        raw_columns = None if self.raw_columns is None else \
+            {column: values[rows] for column, values in self.raw_columns.items()}
+        return InstrumentTable({column: values[rows] for column, values in self.columns.items()},
+                               raw_columns)
+
+    def to_instruments(self) -> [MarketInstrument]:
+        """Return the instruments as MarketInstrument objects."""
+        return [MarketInstrument(**x) for x in _get_column_dicts(self.columns)]
+
+    def to_dicts(self) -> [dict]:
+        """
+        Return the instruments as dicts of property name to value.
+
+        Prices and volume are the attribute values they were parsed from, or floats if those are
+        not known.
+        """
+        return _get_column_dicts({**self.columns, **(self.raw_columns or {})})
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Return the instruments as a Pandas DataFrame with one column per property.
+
+        Prices and volume are float64 columns and market is a categorical column.
+        """
+
+        frame = pd.DataFrame(self.columns, copy=False)
+        frame['market'] = pd.Categorical(self.columns['market'])
+        return frame
+
+
+def _get_column_dicts(columns: dict) -> [dict]:
+    """Convert columns into a dict per row."""
+
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*[columns[x].tolist() for x in names])]
+
+
+# Formats get_market_instruments can return the instruments in.
+_INSTRUMENT_FORMATS = ('objects', 'dicts', 'table', 'frame')
+
+
+def _convert_instruments(instruments: InstrumentTable, return_format: str):
+    """Convert parsed instruments into the requested return format."""
+
+    if return_format == 'dicts':
+        return instruments.to_dicts()
+    if return_format == 'table':
+        return instruments
+    if return_format == 'frame':
+        return instruments.to_frame()
+
+    return instruments.to_instruments()
+
+
+class Metrics:
+    """
+    Receiver of the measurements taken by the queries, install one with set_metrics.
+
+    The base class ignores the measurements. Subclasses export them by overriding increment and
+    observe, names are snake case and every name is always given the same labels:
+
+    * http_requests (action, status), http_request_seconds (action): requests sent and the time
+      until their response headers arrived
+    * http_response_bytes (action), http_retries (action): response bytes read and asyncio client
+      retries
+    * parse_seconds (kind), rows (kind): time spent parsing responses and the instruments or price
+      rows produced, kind is instruments, chart_data or history
+    * cache_hits, cache_misses (cache, kind): lookups of the memory and disk caches
+    * cache_evictions (cache): entries evicted from the memory cache
+    * query_seconds (query): duration of the public query functions
+    """
+
+    def increment(self, name: str, value=1, **labels):
+        """Add the value to a counter."""
+
+    def observe(self, name: str, value: float, **labels):
+        """Record a measurement, durations are in seconds."""
+
+
+class MetricsRecorder(Metrics):
+    """Keeps the measurements in memory, e.g. for tests and profiling."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        # Count, sum, minimum and maximum of the observed values.
+        self._observations = {}
+
+    def increment(self, name: str, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            summary = self._observations.get(key)
+            if summary is None:
+                self._observations[key] = [1, value, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = min(summary[2], value)
+                summary[3] = max(summary[3], value)
+
+    def counter(self, name: str, **labels) -> float:
+        """Return the total of a counter over the label sets matching the given labels."""
+
+        with self._lock:
+            return sum(value for key, value in self._counters.items()
+                       if self._matches(key, name, labels))
+
+    def summary(self, name: str, **labels) -> dict:
+        """Return the count, sum, min and max of the values observed with the matching labels."""
+
+        with self._lock:
+            summaries = [x for key, x in self._observations.items()
+                         if self._matches(key, name, labels)]
+
+        return {
+            'count': sum(x[0] for x in summaries),
+            'sum'  : sum(x[1] for x in summaries),
+            'min'  : min((x[2] for x in summaries), default=None),
+            'max'  : max((x[3] for x in summaries), default=None)
+        }
+
+    def snapshot(self) -> dict:
+        """Return all counters and observation summaries keyed by name and labels."""
+
+        def format_key(key):
+            name, labels = key
+            return name + '{' + ','.join(f'{label}={value}' for label, value in labels) + '}'
+
+        with self._lock:
+            return {
+                'counters'    : {format_key(key): value for key, value in self._counters.items()},
+                'observations': {format_key(key): dict(zip(('count', 'sum', 'min', 'max'), x))
+                                 for key, x in self._observations.items()}
+            }
+
+    def reset(self):
+        """Forget all measurements."""
+
+        with self._lock:
+            self._counters.clear()
+            self._observations.clear()
+
+    @staticmethod
+    def _matches(key, name: str, labels: dict) -> bool:
+        key_name, key_labels = key
+        return key_name == name and labels.items() <= dict(key_labels).items()
+
+
+class PrometheusMetrics(Metrics):
+    """Exports the measurements as prometheus_client counters and histograms."""
+
+    def __init__(self, registry=None, namespace='nasdaqnordic'):
+        if prometheus_client is None:
+            raise ImportError('prometheus_client is required for PrometheusMetrics')
+
+        self.registry = registry or prometheus_client.REGISTRY
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def increment(self, name: str, value=1, **labels):
+        self._get_metric(prometheus_client.Counter, name, labels).inc(value)
+
+    def observe(self, name: str, value: float, **labels):
+        self._get_metric(prometheus_client.Histogram, name, labels).observe(value)
+
+    def _get_metric(self, metric_class, name: str, labels: dict):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, name.replace('_', ' ').capitalize(),
+                                      labelnames=sorted(labels), namespace=self.namespace,
+                                      registry=self.registry)
+                self._metrics[name] = metric
+
+        return metric.labels(**labels) if labels else metric
+
+
+class OpenTelemetryMetrics(Metrics):
+    """Exports the measurements as counters and histograms of an OpenTelemetry meter."""
+
+    def __init__(self, meter, prefix='nasdaqnordic.'):
+        self.meter = meter
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._instruments = {}
+
+    def increment(self, name: str, value=1, **labels):
+        self._get_instrument(self.meter.create_counter, name).add(value, attributes=labels)
+
+    def observe(self, name: str, value: float, **labels):
+        self._get_instrument(self.meter.create_histogram, name).record(value, attributes=labels)
+
+    def _get_instrument(self, create, name: str):
+        with self._lock:
+            instrument = self._instruments.get(name)
+            if instrument is None:
+                unit = 's' if name.endswith('_seconds') else 'By' if name.endswith('_bytes') \
+                    else '1'
+                instrument = create(self.prefix + name, unit=unit)
+                self._instruments[name] = instrument
+
+        return instrument
+
+
+# Receiver of the measurements, None when instrumentation is disabled.
+_metrics = None
+
+
+def get_metrics() -> Metrics:
+    """Return the installed metrics receiver, or None if instrumentation is disabled."""
+    return _metrics
+
+
+def set_metrics(metrics: Metrics):
+    """Install a metrics receiver, None disables instrumentation."""
+
+    global _metrics
+    _metrics = metrics
+
+
+def _increment(name: str, value=1, **labels):
+    metrics = _metrics
+    if metrics is not None:
+        metrics.increment(name, value, **labels)
+
+
+def _observe(name: str, value: float, **labels):
+    metrics = _metrics
+    if metrics is not None:
+        metrics.observe(name, value, **labels)
+
+
+class _Timer:
+    """Context manager observing the time spent in its block."""
+
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        _observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+# Timer used when instrumentation is disabled.
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def _timer(name: str, **labels):
+    """Return a context manager observing the time spent in its block."""
+    return _Timer(name, labels) if _metrics is not None else _NULL_TIMER
+
+
+def _measure_query(fn):
+    """Decorate a public query function to observe its duration as query_seconds."""
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def measured(*args, **kwargs):
+            with _timer('query_seconds', query=fn.__name__):
+                return await fn(*args, **kwargs)
+    else:
+        @functools.wraps(fn)
+        def measured(*args, **kwargs):
+            with _timer('query_seconds', query=fn.__name__):
+                return fn(*args, **kwargs)
+
+    return measured
+
+
+class DataFeedClient:
+    """
+    HTTP client for the DataFeedProxy endpoint.
+
+    Keeps a single requests session with a keep-alive connection pool, so consecutive queries
+    reuse the same TCP connections. Failed requests are retried with exponential backoff.
+    """
+
+    def __init__(self
+                 , api_url=_API_URL
+                 , pool_connections=_DEFAULT_POOL_SIZE
+                 , pool_maxsize=_DEFAULT_POOL_SIZE
+                 , pool_block=False
+                 , timeout=_DEFAULT_TIMEOUT
+                 , max_retries=_DEFAULT_MAX_RETRIES
+                 , backoff_factor=_DEFAULT_BACKOFF_FACTOR
+                 , session: requests.Session = None):
+        """
+        Create a new client.
+
+        :param api_url: DataFeedProxy endpoint url, point this to a local server in tests.
+        :param pool_connections: Number of connection pools (hosts) to cache.
+        :param pool_maxsize: Maximum number of connections kept open per host.
+        :param pool_block: If true, block when the pool is exhausted instead of opening extra
+        connections.
+        :param timeout: Request timeout in seconds, either a number or (connect, read) tuple.
+        :param max_retries: Number of retries for connection errors and 5xx/429 responses.
+        :param backoff_factor: Exponential backoff factor between retries in seconds.
+        :param session: Optional preconfigured requests session, adapters are not mounted on it.
+        """
+
+        self.api_url = api_url
+        self.timeout = timeout
+
+        if session is None:
+            retry = Retry(total=max_retries,
+                          backoff_factor=backoff_factor,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset(['GET']))
+            adapter = HTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize,
+                                  pool_block=pool_block,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        self.session = session
 
+    def get(self, params: dict, stream=False, headers: dict = None) -> requests.Response:
+        """
+        Query the API with the given parameters and return the response.
 
-def _fetch_stock_page(*markets) -> bs4.BeautifulSoup:
-    """Query the instrument list page and return an XML soup."""
+        :param params: Query parameters.
+        :param stream: If true, the body is not read before returning, close the response after
+        reading it.
+        :param headers: Extra request headers, e.g. for conditional requests.
+        """
+
+        action = params.get('Action')
+        with _timer('http_request_seconds', action=action):
+            r = self.session.get(self.api_url, params=params, timeout=self.timeout,
+                                 stream=stream, headers=headers)
+        _increment('http_requests', action=action, status=r.status_code)
+
+        r.raise_for_status()
+        return r
+
+    def close(self):
+        """Close the session and all pooled connections."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Lazily created client shared by all queries that are not given a client explicitly.
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client() -> DataFeedClient:
+    """Return the shared default client, creating it on first use."""
+
+    global _default_client
+
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = DataFeedClient()
+        return _default_client
+
+
+def set_default_client(client: DataFeedClient):
+    """Replace the shared default client, e.g. with one pointing to a local test server."""
+
+    global _default_client
+
+    with _default_client_lock:
+        _default_client = client
+
+
+class AsyncDataFeedClient:
+    """
+    Asyncio HTTP client for the DataFeedProxy endpoint, requires aiohttp.
+
+    All requests share one aiohttp session and its connection pool, so any number of queries can
+    be in flight on a single event loop. Failed requests are retried with exponential backoff.
+    """
+
+    def __init__(self
+                 , api_url=_API_URL
+                 , pool_maxsize=_DEFAULT_POOL_SIZE
+                 , timeout=_DEFAULT_TIMEOUT
+                 , max_retries=_DEFAULT_MAX_RETRIES
+                 , backoff_factor=_DEFAULT_BACKOFF_FACTOR):
+        """
+        Create a new client. The session is opened lazily inside the running event loop.
+
+        :param api_url: DataFeedProxy endpoint url, point this to a local server in tests.
+        :param pool_maxsize: Maximum number of simultaneously open connections.
+        :param timeout: Request timeout in seconds, either a number or (connect, read) tuple.
+        :param max_retries: Number of retries for connection errors and 5xx/429 responses.
+        :param backoff_factor: Exponential backoff factor between retries in seconds.
+        """
+
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for the asyncio API')
+
+        self.api_url = api_url
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.session = None
+
+    def _create_session(self):
+        connect_timeout, read_timeout = self.timeout if isinstance(self.timeout, tuple) else \
+            (self.timeout, self.timeout)
+
+        connector = aiohttp.TCPConnector(limit=self.pool_maxsize)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def request(self, params: dict, read):
+        """
+        Query the API with the given parameters.
+
+        :param params: Query parameters.
+        :param read: Coroutine function reading the result from the aiohttp response.
+        :return: Result of the read function.
+        """
+
+        if self.session is None or self.session.closed:
+            self.session = self._create_session()
+
+        # Use the same string forms of the parameters as requests does.
+        params = {key: str(value) for key, value in params.items()}
+
+        action = params.get('Action')
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with _timer('http_request_seconds', action=action):
+                    response = await self.session.get(self.api_url, params=params)
+                _increment('http_requests', action=action, status=response.status)
+
+                async with response as r:
+                    if r.status in (429, 500, 502, 503, 504) and attempt < self.max_retries:
+                        raise aiohttp.ClientResponseError(r.request_info, r.history,
+                                                          status=r.status)
+                    r.raise_for_status()
+                    return await read(r)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError,
+                    asyncio.TimeoutError) as e:
+                if attempt == self.max_retries or (isinstance(e, aiohttp.ClientResponseError) and
+                                                   e.status < 500 and e.status != 429):
+                    raise
+                delay = self.backoff_factor * (2 ** attempt)
+                _log.warning(f'Request failed ({e}), retrying in {delay} seconds')
+                _increment('http_retries', action=action)
+                await asyncio.sleep(delay)
+
+    async def get_text(self, params: dict) -> str:
+        """Query the API with the given parameters and return the response body."""
+        return await self.request(params, lambda r: r.text())
+
+    async def get_json(self, params: dict) -> dict:
+        """Query the API with the given parameters and return the decoded JSON response."""
+        return await self.request(params, lambda r: r.json(content_type=None))
+
+    async def close(self):
+        """Close the session and all pooled connections."""
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+# Default asyncio clients by event loop, with the asynchronous generators closing them.
+_default_async_clients = weakref.WeakKeyDictionary()
+
+
+async def _close_on_loop_shutdown(client: AsyncDataFeedClient):
+    """
+    Close the client when the event loop shuts down.
+
+    The loop finalizes its asynchronous generators before it is closed, e.g. at the end of
+    asyncio.run, so the session closes while the loop can still run it.
+    """
+
+    try:
+        yield
+    finally:
+        await client.close()
+
+
+def get_default_async_client() -> AsyncDataFeedClient:
+    """Return the default asyncio client of the running event loop, creating it on first use."""
+
+    loop = asyncio.get_running_loop()
+    entry = _default_async_clients.get(loop)
+
+    if entry is None:
+        client = AsyncDataFeedClient()
+        closer = _close_on_loop_shutdown(client)
+        asyncio.ensure_future(closer.__anext__())
+        entry = _default_async_clients[loop] = (client, closer)
+
+    return entry[0]
+
+
+def set_default_async_client(client: AsyncDataFeedClient):
+    """
+    Replace the default asyncio client for the running event loop.
+
+    The caller closes the given client. A default client created before is closed.
+    """
+
+    loop = asyncio.get_running_loop()
+    previous = _default_async_clients.pop(loop, None)
+
+    if client is not None:
+        _default_async_clients[loop] = (client, None)
+
+    # Finalizing the closer of the replaced client closes it.
+    if previous is not None and previous[1] is not None:
+        asyncio.ensure_future(previous[1].aclose())
+
+
+def _get_market_params(markets: [Markets]) -> dict:
+    """Get the instrument list query parameters for the given markets."""
 
     if len(markets) == 0:
         raise ValueError('No markets given')
 
-    params = {
+    return {
         'Exchange' : 'NMF',
         'SubSystem': 'Prices',
         'Action'   : 'GetMarket',
@@ -92,60 +787,152 @@ def _fetch_stock_page(*markets) -> bs4.BeautifulSoup:
         # 'ext_xslt': '/nordicV3/inst_table_shares.xsl'
     }
 
-    r = requests.get(_API_URL, params)
-    response_text = r.text
-    soup = bs4.BeautifulSoup(response_text, 'lxml')
 
-    return soup
+def _fetch_stock_page(*markets, client: DataFeedClient = None,
+                      headers: dict = None) -> requests.Response:
+    """Query the instrument list page and return the streamed XML response."""
 
+    params = _get_market_params(markets)
 
-def _parse_stock_instruments_response(soup: bs4.BeautifulSoup) -> dict:
-    """Parse the XML response soup into dictionary with the relevant information."""
+    client = client or get_default_client()
+    return client.get(params, stream=True, headers=headers)
 
-    # Get markets.
-    markets = soup.find_all('market')
-    if len(markets) == 0:
-        raise ValueError('No markets found')
 
-    instruments = []
+class _StockInstrumentParser:
+    """
+    Incremental parser of the instrument list XML.
 
-    for market in markets:
-        market_name = market.attrs['nm']
-        _log.info(f'Processing market {market_name}')
+    The response is fed in chunks and the attributes of every instrument element are collected
+    into columns as soon as it has been parsed. Parsed elements are dropped, so memory use doesn't
+    grow with the document. Prices and volumes are converted to numbers in bulk when parsing is
+    finished.
+    """
 
-        market_instruments = market.find('instruments')
-        if len(market_instruments) == 0:
-            _log.warning(f'Market {market_name} had no instruments!')
-            continue
+    # Instrument element attributes and the table columns they are collected into.
+    _STRING_ATTRIBUTES = (('id', 'id'), ('nm', 'name'), ('fnm', 'full_name'))
+    _FLOAT_ATTRIBUTES = (('bp', 'bid_price'), ('ap', 'ask_price'), ('lp', 'last_price'),
+                         ('tv', 'total_volume'))
 
-        for market_instrument in market_instruments:
-            instr_attrs = market_instrument.attrs
-
-            # Get instrument identifiers.
-            instrument_id = instr_attrs['id']
-            instrument_name = instr_attrs['nm']
-            instrument_full_name = instr_attrs['fnm']
-
-            # Get instrument details.
-            instrument_bid_price = instr_attrs['bp']
-            instrument_ask_price = instr_attrs['ap']
-            instrument_last_price = instr_attrs['lp']
-            instrument_total_volume = instr_attrs['tv']
-
-            _log.info(f'Found instrument {instrument_name} id {instrument_id}')
-
-            instruments.append({
-                'id'          : instrument_id,
-                'name'        : instrument_name,
-                'full_name'   : instrument_full_name,
-                'market'      : market_name,
-                'bid_price'   : instrument_bid_price,
-                'ask_price'   : instrument_ask_price,
-                'last_price'  : instrument_last_price,
-                'total_volume': instrument_total_volume
-            })
+    def __init__(self):
+        self._parser = etree.XMLPullParser(events=('start', 'end'))
+        self._depth = 0
+        self._instruments_depth = None
+        self._market_name = None
+        self._market_instrument_count = 0
+        self._market_count = 0
+        self._bytes = 0
+        self._parse_seconds = 0.0
+        self._log_instruments = _log.isEnabledFor(logging.DEBUG)
 
-    return instruments
+        self._columns = {column: [] for column in InstrumentTable.STRING_COLUMNS +
+                         InstrumentTable.FLOAT_COLUMNS}
+        self._string_columns = [(attribute, self._columns[column])
+                                for attribute, column in self._STRING_ATTRIBUTES]
+        self._float_columns = [(attribute, self._columns[column])
+                               for attribute, column in self._FLOAT_ATTRIBUTES]
+
+    def feed(self, data: bytes):
+        """Feed a chunk of the response."""
+
+        start = time.perf_counter()
+        self._parser.feed(data)
+        self._read_events()
+
+        self._bytes += len(data)
+        self._parse_seconds += time.perf_counter() - start
+
+    def close(self) -> InstrumentTable:
+        """Finish parsing and return the instruments."""
+
+        start = time.perf_counter()
+        self._parser.close()
+        self._read_events()
+
+        if self._market_count == 0:
+            raise ValueError('No markets found')
+
+        columns = {column: np.array(self._columns[column], dtype=object)
+                   for column in InstrumentTable.STRING_COLUMNS}
+        raw_columns = {}
+        for column in InstrumentTable.FLOAT_COLUMNS:
+            raw_columns[column] = np.array(self._columns[column], dtype=object)
+            columns[column] = _parse_numeric_column(raw_columns[column])
+        instruments = InstrumentTable(columns, raw_columns)
+
+        self._parse_seconds += time.perf_counter() - start
+        _increment('http_response_bytes', self._bytes, action='GetMarket')
+        _observe('parse_seconds', self._parse_seconds, kind='instruments')
+        _increment('rows', len(instruments), kind='instruments')
+
+        return instruments
+
+    def _read_events(self):
+        for event, elem in self._parser.read_events():
+            tag = elem.tag.rsplit('}', 1)[-1].lower()
+
+            if event == 'start':
+                self._depth += 1
+
+                if tag == 'market':
+                    self._market_name = elem.attrib['nm']
+                    self._market_instrument_count = 0
+                    self._market_count += 1
+                    _log.debug(f'Processing market {self._market_name}')
+                elif tag == 'instruments':
+                    self._instruments_depth = self._depth
+                continue
+
+            self._depth -= 1
+
+            if tag == 'instruments':
+                self._instruments_depth = None
+                if self._market_instrument_count == 0:
+                    _log.warning(f'Market {self._market_name} had no instruments!')
+            elif self._instruments_depth is not None and self._depth == self._instruments_depth:
+                self._add_instrument(elem.attrib)
+                self._market_instrument_count += 1
+            elif tag != 'market':
+                continue
+
+            # Drop the processed element and its processed siblings from the tree.
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    def _add_instrument(self, instr_attrs):
+        for attribute, values in self._string_columns:
+            values.append(instr_attrs[attribute])
+
+        # Prices and volume are kept as strings until close, missing ones become NaN.
+        for attribute, values in self._float_columns:
+            values.append(instr_attrs.get(attribute))
+
+        self._columns['market'].append(self._market_name)
+
+        if self._log_instruments:
+            _log.debug(f'Found instrument {instr_attrs["nm"]} id {instr_attrs["id"]}')
+
+
+def _parse_stock_instruments(chunks) -> InstrumentTable:
+    """Parse the instrument list XML from an iterable of byte chunks."""
+
+    parser = _StockInstrumentParser()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+
+    return parser.close()
+
+
+def _parse_stock_instruments_response(response) -> InstrumentTable:
+    """Parse the XML instrument list response, or its body as bytes, into an InstrumentTable."""
+
+    if isinstance(response, bytes):
+        chunks = [response]
+    else:
+        chunks = response.iter_content(chunk_size=_CHUNK_SIZE)
+
+    return _parse_stock_instruments(chunks)
 
 
 def filter_market_instruments(instruments: [MarketInstrument], name_like: str) -> [
@@ -173,185 +960,2046 @@ def filter_market_instruments(instruments: [MarketInstrument], name_like: str) -
     return result
 
 
-def _validate_dates(*dates):
-    for date in dates:
-        if isinstance(date, datetime):
-            continue
-        try:
-            dateutil.parser.parse(date)
-        except ValueError:
-            raise ValueError(f'Invalid date string {date}')
+class _AhoCorasick:
+    """Aho-Corasick automaton finding all of a set of patterns in a text in a single pass."""
+
+    def __init__(self, patterns: [str]):
+        # Transitions, failure links and the indices of the patterns ending at each state.
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]
+
+        for pattern_index, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(set())
+                state = next_state
+            self._output[state].add(pattern_index)
+
+        # Breadth first, so the failure link of every shorter state is set first.
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] |= self._output[self._fail[next_state]]
+
+    def find(self, text: str) -> set:
+        """Return the indices of the patterns found in the text."""
+
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set(output[0])
+        state = 0
+
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            found |= output[state]
+
+        return found
+
+
+def filter_market_instruments_many(instruments: [MarketInstrument], patterns: [str]) -> dict:
+    """
+    Filter MarketInstruments by many partial names at once.
 
+    Matches like filter_market_instruments, but all patterns are matched in a single pass over
+    the names of the instruments.
 
-def _get_cached_instrument_file(cache_files: [str], instrument_name: str, start_date: str,
-                                end_date: str):
-    parsed_start_date = dateutil.parser.parse(start_date)
-    parsed_end_date = dateutil.parser.parse(end_date)
+    :param instruments: Instruments to filter.
+    :param patterns: Partial names matched against shortened and full names, case insensitive.
+    :return: Dictionary of pattern to list of matching MarketInstruments.
+    """
 
-    for cache_file in cache_files:
-        file_parts = cache_file.split('.')[0].split('_')
-        if len(file_parts) != 3:
-            continue
+    patterns = list(dict.fromkeys(patterns))
+    automaton = _AhoCorasick([x.lower() for x in patterns])
 
-        cached_instrument_name = file_parts[0]
-        cached_start_date = file_parts[1]
-        cached_end_date = file_parts[2]
+    result = {pattern: [] for pattern in patterns}
 
-        if cached_instrument_name != instrument_name:
-            continue
+    for instrument in instruments:
+        matches = automaton.find(instrument.name.lower().strip())
+        matches |= automaton.find(instrument.full_name.lower().strip())
 
-        try:
-            parsed_cache_start_date = dateutil.parser.parse(cached_start_date)
-            parsed_cache_end_date = dateutil.parser.parse(cached_end_date)
-        except ValueError:
-            _log.error(f'Failed to parse dates from cache file {cache_file}')
-            continue
+        for pattern_index in matches:
+            result[patterns[pattern_index]].append(instrument)
 
-        if parsed_cache_start_date >= parsed_start_date and parsed_cache_end_date <= \
-                parsed_end_date:
-            return cache_file
+    return result
 
-    return None
 
+def _get_qgrams(text: str, q: int) -> set:
+    """Get the set of q character substrings of the text."""
+    return {text[i:i + q] for i in range(len(text) - q + 1)}
 
-def _create_dir_if_not_exists(dir: str):
-    """Create (cache) directory if it does not exists."""
 
-    if os.path.exists(dir) and not os.path.isdir(dir):
-        raise ValueError(f'Provided path {dir} was not a directory')
+def _get_trigrams(text: str) -> set:
+    """Get the set of three character substrings of the text."""
+    return _get_qgrams(text, 3)
 
-    if not os.path.exists(dir):
-        _log.info(f'Creating directory {dir}')
-        os.mkdir(dir)
 
+def _get_pattern_masks(pattern: str) -> dict:
+    """Get the bit mask of the positions of every character of the pattern."""
 
-def _get_instrument_list_filename(markets: [Markets], date: datetime):
-    """Get file name for instrument list cache file."""
+    masks = defaultdict(int)
+    for i, char in enumerate(pattern):
+        masks[char] |= 1 << i
+    return dict(masks)
 
-    date_string = date.isoformat()[:10]
-    markets_str = '_'.join(sorted([x.value[-4:] for x in markets]))
 
-    return f'instruments_{date_string}_{markets_str}.data'
+def _get_substring_edit_distance(pattern: str, text: str, pattern_masks: dict = None) -> int:
+    """
+    Get the smallest edit distance between the pattern and any substring of the text.
 
+    Uses the bit-parallel algorithm of Myers, which keeps a column of the edit distance table as
+    bit vectors of the vertical deltas, so each character of the text takes a few integer
+    operations instead of a loop over the pattern.
 
-def _get_cached_instrument_list(markets: [Markets], date: datetime, cache_dir):
-    cache_files = os.listdir(cache_dir)
+    :param pattern_masks: Masks of the pattern from _get_pattern_masks, when searching many texts.
+    """
 
-    current_date_cache_file = _get_instrument_list_filename(markets, date)
-    matching_cache_files = [x for x in cache_files if x == current_date_cache_file]
+    if not pattern:
+        return 0
 
-    return matching_cache_files[0] if any(matching_cache_files) else None
+    if pattern_masks is None:
+        pattern_masks = _get_pattern_masks(pattern)
 
+    all_ones = (1 << len(pattern)) - 1
+    last_bit = 1 << (len(pattern) - 1)
 
-def _get_instrument_cache_file_path(instrument_name, start_date, end_date, cache_dir):
-    """Get full file path for stock query cache file."""
+    # Positive and negative vertical deltas, the first column is 0, 1, 2, ...
+    positive, negative = all_ones, 0
+    distance = best = len(pattern)
 
-    identifier = f'{instrument_name}_{start_date}_{end_date}'
-    return os.path.join(cache_dir, f'{identifier}.data')
+    for char in text:
+        equal = pattern_masks.get(char, 0)
+        vertical = equal | negative
+        horizontal = (((equal & positive) + positive) ^ positive) | equal
+        positive_horizontal = negative | (~(horizontal | positive) & all_ones)
+        negative_horizontal = positive & horizontal
 
+        if positive_horizontal & last_bit:
+            distance += 1
+        elif negative_horizontal & last_bit:
+            distance -= 1
+            if distance < best:
+                best = distance
 
-def get_stock_df(instrument_id: str
-                 , start_date: any
-                 , end_date: any
-                 , load_from_cache=True
-                 , save_to_cache=True
-                 , cache_dir=_DEFAULT_CACHE_DIR
-                 , return_only_df=True):
+        # Matching may start anywhere in the text, so no delta is shifted into the first row.
+        positive_horizontal = (positive_horizontal << 1) & all_ones
+        negative_horizontal = (negative_horizontal << 1) & all_ones
+        positive = negative_horizontal | (~(vertical | positive_horizontal) & all_ones)
+        negative = positive_horizontal & vertical
+
+    return best
+
+
+class InstrumentIndex:
     """
-    Query price history for a specific market item (stock).
+    Search index over the names and full names of market instruments.
 
-    :param instrument_id: Instrument identifier, as returned by the market instrument query.
-    :param start_date: Price date range start as ISO date string or datetime object.
-    :param end_date: Price date range end as ISO date string or datetime object.
-    :param load_from_cache: If true, allow loading from cache if the query range fits the cache
-    file.
-    :param save_to_cache: If true, store the result to cache file.
-    :param cache_dir: Cache directory.
-    :param return_only_df: If true, return only the DataFrame without company info.
-    :return: Dictionary containing company information and Pandas DataFrame containing the stock
-    price from the provided
-    date range.
+    Build it once when the instruments are loaded and reuse it for every query. Names are indexed
+    by their one, two and three character substrings for substring and fuzzy queries and kept
+    sorted for prefix queries. One and two character substring queries, the first keystrokes of a
+    search, are answered from lists kept in rank order instead of scanning the names.
     """
 
-    if not instrument_id.startswith('HEX'):
-        raise ValueError(f'Invalid instrument name {instrument_id}')
+    SEARCH_MODES = ('prefix', 'substring', 'fuzzy')
 
-    _validate_dates(start_date, end_date)
+    # Lengths of the substrings the names are indexed by.
+    _QGRAM_SIZES = (1, 2, 3)
 
-    # Convert datetimes to ISO format strings if they aren't already.
-    start_date = start_date.isoformat()[:10] if isinstance(start_date, datetime) else start_date
-    end_date = end_date.isoformat()[:10] if isinstance(end_date, datetime) else end_date
+    def __init__(self, instruments):
+        """
+        Build the index.
 
-    file_path = _get_instrument_cache_file_path(instrument_id, start_date, end_date, cache_dir)
+        :param instruments: List of MarketInstruments or an InstrumentTable.
+        """
 
-    if load_from_cache or save_to_cache:
-        _create_dir_if_not_exists(cache_dir)
+        self._instruments = instruments
 
-    if load_from_cache:
-        cache_files = os.listdir(cache_dir)
-        cached_file = _get_cached_instrument_file(cache_files, instrument_id, start_date,
-                                                  end_date)
+        if isinstance(instruments, InstrumentTable):
+            names, full_names = instruments['name'], instruments['full_name']
+        else:
+            names = [x.name for x in instruments]
+            full_names = [x.full_name for x in instruments]
 
-        if cached_file is not None:
-            cached_file = os.path.join(_DEFAULT_CACHE_DIR, cached_file)
-            _log.info('Loading from cache')
+        # Lowercased name and full name of every instrument.
+        self._texts = [(name.lower().strip(), full_name.lower().strip()) for name, full_name in
+                       zip(names, full_names)]
 
-            with open(cached_file, 'rb') as f:
-                cached_data = pickle.load(f)
-                return cached_data['Value'] if return_only_df else cached_data
+        self._qgrams = {q: defaultdict(set) for q in self._QGRAM_SIZES}
+        self._sorted_texts = sorted((text, position) for position, texts in enumerate(self._texts)
+                                    for text in texts)
 
-    params = {
-        'SubSystem'      : 'History',
-        'Action'         : 'GetChartData',
-        'FromDate'       : start_date,
-        'ToDate'         : end_date,
-        'json'           : True,
-        'showAdjusted'   : True,
-        'app'            : '/osakkeet/historiallisetkurssitiedot-HistoryChar',
-        'DefaultDecimals': False,
+        # Positions of the names containing every one and two character substring, by the index of
+        # its first occurrence or -1 if it is the whole name. The names are added shortest first,
+        # so every list is in rank order.
+        self._short_matches = defaultdict(list)
+        self._short_results = {}
+        self._max_text_length = 0
+
+        for text, position in sorted(self._sorted_texts, key=lambda x: (len(x[0]), x[0])):
+            self._max_text_length = max(self._max_text_length, len(text))
+
+            first_indices = {}
+            for i in range(len(text)):
+                first_indices.setdefault(text[i], i)
+                first_indices.setdefault(text[i:i + 2], i)
+
+            for qgram, index in first_indices.items():
+                self._qgrams[len(qgram)][qgram].add(position)
+                self._short_matches[qgram, -1 if qgram == text else index].append(position)
+
+            for trigram in _get_trigrams(text):
+                self._qgrams[3][trigram].add(position)
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def search(self, query: str, mode='substring', max_distance=1, limit: int = None) -> [
+        MarketInstrument]:
+        """
+        Find instruments whose name or full name matches the query, best matches first.
+
+        :param query: Partial name, case insensitive.
+        :param mode: 'prefix' to match the start of the names, 'substring' to match anywhere in
+        the names or 'fuzzy' to match anywhere allowing up to max_distance edits.
+        :param max_distance: Maximum edit distance of fuzzy matches.
+        :param limit: Maximum number of results.
+        :return: Matching instruments ranked by match quality.
+        """
+
+        if mode not in self.SEARCH_MODES:
+            raise ValueError(f'Invalid search mode {mode}')
+
+        query = query.lower().strip()
+
+        if mode == 'prefix':
+            positions = self._search_prefix(query)
+        elif mode == 'substring':
+            positions = self._search_substring(query)
+        else:
+            positions = self._search_fuzzy(query, max_distance)
+
+        positions = positions[:limit]
+
+        # Convert the rows of a table at once instead of one instrument at a time.
+        if isinstance(self._instruments, InstrumentTable):
+            return self._instruments.select(np.array(positions, dtype=np.int64)).to_instruments()
+        return [self._instruments[x] for x in positions]
+
+    def _get_candidates(self, query: str, q: int, min_shared_qgrams: int):
+        """Get positions sharing at least the given number of q character substrings with the query."""
+
+        qgrams = _get_qgrams(query, q)
+        if min_shared_qgrams <= 0 or not qgrams:
+            return range(len(self._texts))
+
+        postings = self._qgrams[q]
+
+        if min_shared_qgrams == len(qgrams):
+            return set.intersection(*sorted((postings.get(x, set()) for x in qgrams), key=len))
+
+        counts = defaultdict(int)
+        for qgram in qgrams:
+            for position in postings.get(qgram, ()):
+                counts[position] += 1
+
+        return [position for position, count in counts.items() if count >= min_shared_qgrams]
+
+    @staticmethod
+    def _get_ranked_positions(ranked) -> [int]:
+        return [position for _, position in sorted(ranked)]
+
+    def _search_prefix(self, query: str):
+        best = {}
+
+        start = bisect.bisect_left(self._sorted_texts, (query,))
+        for text, position in self._sorted_texts[start:]:
+            if not text.startswith(query):
+                break
+            rank = (text != query, len(text), text)
+            best[position] = min(best.get(position, rank), rank)
+
+        return self._get_ranked_positions((rank, position) for position, rank in best.items())
+
+    def _search_short_substring(self, query: str):
+        results = self._short_results.get(query)
+
+        if results is None:
+            # Merge the lists of the first occurrence indices, keeping the best rank of each
+            # instrument.
+            results = []
+            found = set()
+            for index in range(-1, self._max_text_length):
+                for position in self._short_matches.get((query, index), ()):
+                    if position not in found:
+                        found.add(position)
+                        results.append(position)
+            self._short_results[query] = results
+
+        return results
+
+    def _search_substring(self, query: str):
+        if 0 < len(query) < 3:
+            return self._search_short_substring(query)
+
+        ranked = []
+
+        for position in self._get_candidates(query, 3, len(_get_trigrams(query))):
+            ranks = [(text != query, text.find(query), len(text), text) for text in
+                     self._texts[position] if query in text]
+            if ranks:
+                ranked.append((min(ranks), position))
+
+        return self._get_ranked_positions(ranked)
+
+    def _get_fuzzy_candidates(self, query: str, max_distance: int):
+        """Get positions that may match the query with at most max_distance edits."""
+
+        # Split the query into max_distance + 1 pieces. The edits of a match can touch at most
+        # max_distance of them, so a match contains at least one piece unchanged.
+        pieces = max_distance + 1
+        if len(query) < pieces:
+            return range(len(self._texts))
+
+        piece_length = len(query) // pieces
+        candidates = set()
+
+        for i in range(pieces):
+            piece = query[i * piece_length:(i + 1) * piece_length if i < pieces - 1 else None]
+            if len(piece) < 3:
+                candidates |= self._qgrams[len(piece)].get(piece, set())
+            else:
+                candidates.update(self._get_candidates(piece, 3, len(_get_trigrams(piece))))
+
+        return candidates
+
+    def _search_fuzzy(self, query: str, max_distance: int):
+        ranked = []
+        pattern_masks = _get_pattern_masks(query)
+
+        for position in self._get_fuzzy_candidates(query, max_distance):
+            ranks = []
+            for text in self._texts[position]:
+                distance = 0 if query in text else \
+                    _get_substring_edit_distance(query, text, pattern_masks)
+                if distance <= max_distance:
+                    ranks.append((distance, len(text), text))
+            if ranks:
+                ranked.append((min(ranks), position))
+
+        return self._get_ranked_positions(ranked)
+
+
+def _validate_dates(*dates):
+    for date_value in dates:
+        if isinstance(date_value, date):
+            continue
+        try:
+            dateutil.parser.parse(date_value)
+        except ValueError:
+            raise ValueError(f'Invalid date string {date_value}')
+
+
+class MemoryCache:
+    """
+    Thread-safe in-memory LRU cache in front of the disk cache.
+
+    Entries are evicted least recently used first when the entry count or the estimated total
+    size would exceed the limits, and expire after ttl seconds if one is given.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=256 * 1024 * 1024, ttl: float = None):
+        """
+        Create a new cache.
+
+        :param max_entries: Maximum number of entries.
+        :param max_bytes: Maximum estimated total size of the entries in bytes.
+        :param ttl: Maximum age of entries in seconds, None to keep them until evicted.
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the value of the key, or None if it is not cached or has expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store the value, evicting the least recently used entries if the cache is full."""
+
+        size = _get_value_size(value)
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        evictions = 0
+
+        with self._lock:
+            # The old value is stale even if the new one is too big to keep.
+            if key in self._entries:
+                self._remove(key)
+
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, size, expires)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                evictions += 1
+
+            self.evictions += evictions
+
+        if evictions:
+            _increment('cache_evictions', evictions, cache='memory')
+
+    def discard(self, predicate):
+        """Remove the entries whose key matches the predicate."""
+
+        with self._lock:
+            for key in [x for x in self._entries if predicate(x)]:
+                self._remove(key)
+
+    def clear(self):
+        """Remove all entries, the statistics are kept."""
+
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Return the hit, miss and eviction counts and the current entry count and size."""
+
+        with self._lock:
+            return {
+                'hits'     : self.hits,
+                'misses'   : self.misses,
+                'evictions': self.evictions,
+                'entries'  : len(self._entries),
+                'bytes'    : self._bytes
+            }
+
+    def _remove(self, key):
+        value, size, expires = self._entries.pop(key)
+        self._bytes -= size
+
+
+def _get_value_size(value) -> int:
+    """Estimate the memory used by a cached value in bytes."""
+
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, InstrumentTable):
+        columns = [*value.columns.values(), *(value.raw_columns or {}).values()]
+        return sum(x.nbytes + (sum(sys.getsizeof(y) for y in x) if x.dtype == object else 0)
+                   for x in columns)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_get_value_size(x) for x in value.values())
+    if isinstance(value, list):
+        return sys.getsizeof(value) + sum(_get_value_size(x) for x in value)
+
+    return sys.getsizeof(value)
+
+
+def _copy_cached_value(value):
+    """Copy a query result so that callers can't modify the value kept in memory."""
+
+    if isinstance(value, InstrumentTable):
+        raw_columns = None if value.raw_columns is None else \
+            {column: x.copy() for column, x in value.raw_columns.items()}
+        return InstrumentTable({column: x.copy() for column, x in value.columns.items()},
+                               raw_columns)
+
+    return {**value, 'Value': value['Value'].copy()}
+
+
+# Memory cache shared by all queries, None when disabled.
+_memory_cache = MemoryCache()
+
+
+def get_memory_cache() -> MemoryCache:
+    """Return the shared memory cache, or None if it is disabled."""
+    return _memory_cache
+
+
+def set_memory_cache(memory_cache: MemoryCache):
+    """Replace the shared memory cache, None disables it."""
+
+    global _memory_cache
+    _memory_cache = memory_cache
+
+
+def _get_memory_cached(key):
+    """Get a copy of a value from the shared memory cache, or None."""
+
+    memory_cache = _memory_cache
+    if memory_cache is None or key is None:
+        return None
+
+    value = memory_cache.get(key)
+    _increment('cache_hits' if value is not None else 'cache_misses', cache='memory', kind=key[0])
+
+    return _copy_cached_value(value) if value is not None else None
+
+
+def _put_memory_cached(key, value):
+    """Store a copy of a value in the shared memory cache."""
+
+    memory_cache = _memory_cache
+    if memory_cache is not None and key is not None:
+        memory_cache.put(key, _copy_cached_value(value))
+
+
+def _get_stock_memory_key(instrument_id: str, start_date: date, end_date: date, cache_dir,
+                          timezone, columns: [str] = None):
+    """Get the memory cache key of a history query, or None if its result may still change."""
+
+    if end_date > _get_last_complete_date():
+        return None
+
+    return ('history', os.path.abspath(cache_dir), instrument_id, start_date, end_date,
+            str(timezone), tuple(columns) if columns is not None else None)
+
+
+def _discard_memory_cached_stock(instrument_id: str, cache_dir):
+    """Remove the history query results of an instrument from the shared memory cache."""
+
+    memory_cache = _memory_cache
+    if memory_cache is not None:
+        prefix = ('history', os.path.abspath(cache_dir), instrument_id)
+        memory_cache.discard(lambda key: key[:3] == prefix)
+
+
+class CacheCatalog:
+    """
+    SQLite index of the files in a cache directory.
+
+    Records the price history file and covered date ranges of every instrument and the instrument
+    list file of every set of markets and date, so cache lookups are single indexed queries instead
+    of directory scans.
+    """
+
+    FILENAME = 'catalog.sqlite'
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, self.FILENAME)
+
+        # SQLite connections can't be shared between threads, so keep one per thread.
+        self._local = threading.local()
+
+        self._connect()
+
+    def _get_file_id(self):
+        """Get the identity of the database file, or None if it doesn't exist."""
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        file_id = self._get_file_id()
+
+        # Reopen if the database was deleted or replaced since this thread connected, e.g. when
+        # the cache directory was removed, so entries aren't written into an unlinked file.
+        if conn is not None and (file_id is None or file_id != self._local.file_id):
+            _log.info(f'Cache catalog {self.path} was removed or replaced, reopening')
+            conn.close()
+            conn = None
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS history ('
+                             'instrument_id TEXT PRIMARY KEY, file TEXT NOT NULL, '
+                             'coverage TEXT NOT NULL)')
+                conn.execute('CREATE TABLE IF NOT EXISTS instrument_lists ('
+                             'markets TEXT NOT NULL, date TEXT NOT NULL, file TEXT NOT NULL, '
+                             'PRIMARY KEY (markets, date))')
+            self._local.conn = conn
+            self._local.file_id = self._get_file_id()
+        return conn
+
+    def get_history(self, instrument_id: str):
+        """Return (file name, covered date ranges) of an instrument, or None if not cached."""
+
+        row = self._connect().execute('SELECT file, coverage FROM history WHERE instrument_id = ?',
+                                      (instrument_id,)).fetchone()
+        if row is None:
+            return None
+
+        coverage = [(date.fromisoformat(start), date.fromisoformat(end)) for start, end in
+                    json.loads(row[1])]
+        return row[0], coverage
+
+    def put_history(self, instrument_id: str, file_name: str, coverage: [(date, date)]):
+        """Record the file and covered date ranges of an instrument."""
+
+        coverage_json = json.dumps([(start.isoformat(), end.isoformat()) for start, end in
+                                    coverage])
+
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO history (instrument_id, file, coverage) '
+                         'VALUES (?, ?, ?)', (instrument_id, file_name, coverage_json))
+
+    def get_instrument_list(self, markets_key: str, date_string: str):
+        """Return the instrument list file name of the markets and date, or None if not cached."""
+
+        row = self._connect().execute('SELECT file FROM instrument_lists '
+                                      'WHERE markets = ? AND date = ?',
+                                      (markets_key, date_string)).fetchone()
+        return row[0] if row is not None else None
+
+    def put_instrument_list(self, markets_key: str, date_string: str, file_name: str):
+        """Record the instrument list file of the markets and date."""
+
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO instrument_lists (markets, date, file) '
+                         'VALUES (?, ?, ?)', (markets_key, date_string, file_name))
+
+
+# Catalogs of the cache directories used in this process. They reopen their database file if it
+# is removed or replaced, so a deleted cache directory is picked up without a restart.
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def _get_catalog(cache_dir) -> CacheCatalog:
+    """Get the catalog of a cache directory, opening it on first use."""
+
+    key = os.path.abspath(cache_dir)
+
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            catalog = _catalogs[key] = CacheCatalog(cache_dir)
+        return catalog
+
+
+def _create_dir_if_not_exists(dir: str):
+    """Create (cache) directory if it does not exists."""
+
+    if os.path.exists(dir) and not os.path.isdir(dir):
+        raise ValueError(f'Provided path {dir} was not a directory')
+
+    if not os.path.exists(dir):
+        _log.info(f'Creating directory {dir}')
+        os.makedirs(dir, exist_ok=True)
+
+
+def _get_instrument_list_filename(markets: [Markets], date: datetime):
+    """Get file name for instrument list cache file."""
+
+    date_string = date.isoformat()[:10]
+    markets_str = _get_markets_key(markets)
+
+    return f'instruments_{date_string}_{markets_str}.data'
+
+
+def _get_markets_key(markets: [Markets]) -> str:
+    """Get the catalog key of a set of markets."""
+    return '_'.join(sorted([x.value[-4:] for x in markets]))
+
+
+# Header of the pickle cache files: magic bytes, CRC32 and length of the pickled data.
+_PICKLE_MAGIC = b'NNQ1'
+_PICKLE_HEADER = struct.Struct('<4sIQ')
+
+
+def _dump_pickle(value, file_path: str):
+    """Pickle the value to the file with a checksum header."""
+
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    with open(file_path, 'wb') as f:
+        f.write(_PICKLE_HEADER.pack(_PICKLE_MAGIC, zlib.crc32(data), len(data)))
+        f.write(data)
+
+
+def _load_pickle(file_path: str):
+    """Load a pickle written by _dump_pickle, raise ValueError if it fails the checksum."""
+
+    with open(file_path, 'rb') as f:
+        content = f.read()
+
+    # Files written before the checksum header was added.
+    if not content.startswith(_PICKLE_MAGIC):
+        return pickle.loads(content)
+
+    magic, checksum, length = _PICKLE_HEADER.unpack_from(content)
+    data = memoryview(content)[_PICKLE_HEADER.size:]
+
+    if len(data) != length or zlib.crc32(data) != checksum:
+        raise ValueError(f'Corrupted cache file {file_path}')
+
+    return pickle.loads(data)
+
+
+def _write_atomic(file_path: str, write):
+    """
+    Write a file through a temporary file that is renamed over it.
+
+    Readers in other threads and processes see either the old or the new file, never a partial
+    one.
+
+    :param file_path: Final file path.
+    :param write: Function writing the content to the path it is given.
+    """
+
+    directory, file_name = os.path.split(file_path)
+    fd, temp_path = tempfile.mkstemp(dir=directory or '.', prefix=f'.{file_name}.', suffix='.tmp')
+    os.close(fd)
+
+    try:
+        write(temp_path)
+
+        with open(temp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@contextlib.contextmanager
+def _file_lock(lock_path: str):
+    """Hold an exclusive lock on the lock file, shared between threads and processes on Unix."""
+
+    if fcntl is None:
+        yield
+        return
+
+    with open(lock_path, 'a+') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _load_cached_instrument_list(markets: [Markets], cache_dir):
+    """Load the instrument list of the current date from memory or disk cache, or return None."""
+
+    date_string = datetime.now().isoformat()[:10]
+
+    memory_key = ('instruments', os.path.abspath(cache_dir), _get_markets_key(markets),
+                  date_string)
+    memory_cached = _get_memory_cached(memory_key)
+    if memory_cached is not None:
+        return memory_cached
+
+    instruments = _read_cached_instrument_list(markets, cache_dir, date_string)
+    _increment('cache_hits' if instruments is not None else 'cache_misses', cache='disk',
+               kind='instruments')
+
+    if instruments is not None:
+        _put_memory_cached(memory_key, instruments)
+    return instruments
+
+
+def _read_cached_instrument_list(markets: [Markets], cache_dir, date_string: str):
+    """Read the instrument list of the date from disk cache, or return None."""
+
+    cached_instruments = _get_catalog(cache_dir).get_instrument_list(_get_markets_key(markets),
+                                                                     date_string)
+    if cached_instruments is None:
+        return None
+
+    cached_instruments_full_path = os.path.join(cache_dir, cached_instruments)
+    if not os.path.exists(cached_instruments_full_path):
+        _log.warning(f'Cache file {cached_instruments} listed in catalog is missing')
+        return None
+
+    _log.info('Loading from cache')
+
+    try:
+        cached = _load_pickle(cached_instruments_full_path)
+    except (ValueError, EOFError, pickle.UnpicklingError) as e:
+        _log.error(f'Ignoring unreadable cache file {cached_instruments}: {e}')
+        return None
+
+    # Files written before the instruments were stored as columns hold a list of dicts, and files
+    # written before the raw attribute values were kept hold only the columns.
+    if isinstance(cached, list):
+        return InstrumentTable.from_json_results(cached)
+    if 'columns' not in cached:
+        return InstrumentTable(cached)
+
+    return InstrumentTable(cached['columns'], cached['raw_columns'])
+
+
+def _save_cached_instrument_list(instruments: InstrumentTable, markets: [Markets], cache_dir):
+    """Store the instrument list for the current date."""
+
+    _log.debug('Storing instruments for this date')
+    now = datetime.now()
+    cached_instruments_filename = _get_instrument_list_filename(markets, now)
+
+    cached_instruments_full_path = os.path.join(cache_dir, cached_instruments_filename)
+
+    _write_atomic(cached_instruments_full_path,
+                  lambda path: _dump_pickle({'columns': instruments.columns,
+                                             'raw_columns': instruments.raw_columns}, path))
+
+    _get_catalog(cache_dir).put_instrument_list(_get_markets_key(markets), now.isoformat()[:10],
+                                                cached_instruments_filename)
+
+    _put_memory_cached(('instruments', os.path.abspath(cache_dir), _get_markets_key(markets),
+                        now.isoformat()[:10]), instruments)
+
+
+def _get_timestamp_filter(start_date: date, end_date: date):
+    """Get inclusive epoch timestamp bounds that contain the whole date range in any timezone."""
+
+    lower = datetime.combine(start_date - timedelta(days=1), datetime.min.time())
+    upper = datetime.combine(end_date + timedelta(days=2), datetime.min.time())
+
+    return int(lower.timestamp()), int(upper.timestamp())
+
+
+class PickleCacheBackend:
+    """Price history cache backend storing the company information and DataFrame as a pickle."""
+
+    extension = 'data'
+
+    def write(self, file_path: str, cached: dict):
+        """Write the company information and price DataFrame to the file."""
+
+        _dump_pickle(cached, file_path)
+
+    def read(self, file_path: str, start_date: date = None, end_date: date = None,
+             columns: [str] = None) -> dict:
+        """
+        Read the company information and price DataFrame from the file.
+
+        :param file_path: Cache file path.
+        :param start_date: If given, rows before this date may be skipped.
+        :param end_date: If given, rows after this date may be skipped.
+        :param columns: If given, only these DataFrame columns are needed.
+        :return: Dictionary containing company information and price DataFrame.
+        """
+
+        cached = _load_pickle(file_path)
+
+        if columns is not None:
+            cached['Value'] = cached['Value'][columns]
+
+        return cached
+
+
+class _ArrowCacheBackend:
+    """Base class for the cache backends storing the price DataFrame as an Arrow table."""
+
+    extension = None
+
+    # Schema metadata key holding the company information.
+    _METADATA_KEY = b'nasdaqnordic_query'
+
+    def __init__(self):
+        if pyarrow is None:
+            raise ImportError('pyarrow is required for the Parquet and Feather cache backends')
+
+    def _to_table(self, cached: dict):
+        values = cached['Value']
+        table = pyarrow.Table.from_pandas(values, preserve_index=False)
+
+        # Parquet has no second resolution timestamps, so the unit is restored when reading.
+        company_info = json.dumps({'Company'     : cached['Company'],
+                                   'Stock'       : cached['Stock'],
+                                   'DateTimeUnit': values['DateTime'].dtype.unit})
+
+        return table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                              self._METADATA_KEY: company_info})
+
+    def _from_table(self, table, metadata) -> dict:
+        company_info = json.loads(metadata[self._METADATA_KEY])
+        # Files written without the unit hold prices parsed from second resolution timestamps.
+        unit = company_info.pop('DateTimeUnit', 's')
+
+        values = table.to_pandas()
+        if 'DateTime' in values:
+            values['DateTime'] = values['DateTime'].astype(
+                f'datetime64[{unit}, {values["DateTime"].dt.tz}]', copy=False)
+
+        return {**company_info, 'Value': values}
+
+
+class ParquetCacheBackend(_ArrowCacheBackend):
+    """
+    Price history cache backend storing the DataFrame as Parquet, requires pyarrow.
+
+    Files are read memory-mapped, with column projection and the date range pushed down as a
+    row group filter.
+    """
+
+    extension = 'parquet'
+
+    def __init__(self, compression='snappy'):
+        super().__init__()
+        self.compression = compression
+
+    def write(self, file_path: str, cached: dict):
+        pyarrow.parquet.write_table(self._to_table(cached), file_path,
+                                    compression=self.compression)
+
+    def read(self, file_path: str, start_date: date = None, end_date: date = None,
+             columns: [str] = None) -> dict:
+        filters = None
+        if start_date is not None and end_date is not None:
+            lower, upper = _get_timestamp_filter(start_date, end_date)
+            filters = [('Timestamp', '>=', lower), ('Timestamp', '<=', upper)]
+
+        table = pyarrow.parquet.read_table(file_path, columns=columns, filters=filters,
+                                           memory_map=True)
+        metadata = pyarrow.parquet.read_schema(file_path, memory_map=True).metadata
+
+        return self._from_table(table, metadata)
+
+
+class FeatherCacheBackend(_ArrowCacheBackend):
+    """
+    Price history cache backend storing the DataFrame as Feather (Arrow IPC), requires pyarrow.
+
+    Uncompressed files are memory-mapped without copying, only the projected columns and the rows
+    of the date range are converted to pandas.
+    """
+
+    extension = 'feather'
+
+    def __init__(self, compression='uncompressed'):
+        super().__init__()
+        self.compression = compression
+
+    def write(self, file_path: str, cached: dict):
+        pyarrow.feather.write_feather(self._to_table(cached), file_path,
+                                      compression=self.compression)
+
+    def read(self, file_path: str, start_date: date = None, end_date: date = None,
+             columns: [str] = None) -> dict:
+        read_columns = columns
+        if columns is not None and start_date is not None and 'Timestamp' not in columns:
+            read_columns = columns + ['Timestamp']
+
+        table = pyarrow.feather.read_table(file_path, columns=read_columns, memory_map=True)
+
+        if start_date is not None and end_date is not None:
+            lower, upper = _get_timestamp_filter(start_date, end_date)
+            timestamps = table.column('Timestamp')
+            table = table.filter(pyarrow.compute.and_(
+                pyarrow.compute.greater_equal(timestamps, lower),
+                pyarrow.compute.less_equal(timestamps, upper)))
+
+        if read_columns is not columns:
+            table = table.select(columns)
+
+        return self._from_table(table, table.schema.metadata)
+
+
+class MemoryMappedCacheBackend:
+    """
+    Price history cache backend storing the price columns as raw arrays that are memory-mapped.
+
+    All processes reading a file map the same page cache pages, and the DataFrame columns returned
+    are views into the mapping, so memory use stays flat however many worker processes load the
+    same histories. The memory cache keeps private copies of query results, disable it with
+    set_memory_cache(None) to keep the results shared.
+    """
+
+    extension = 'arrays'
+
+    # The file starts with the magic and the length of the JSON header, followed by the header and
+    # the Timestamp, Value and DateTime columns as int64 arrays aligned to 64 bytes.
+    _MAGIC = b'NNQA'
+    _PREFIX = struct.Struct('<4sI')
+    _ALIGNMENT = 64
+    _COLUMNS = ('Timestamp', 'Value', 'DateTime')
+
+    def _get_data_offset(self, header_size: int) -> int:
+        return -(-(self._PREFIX.size + header_size) // self._ALIGNMENT) * self._ALIGNMENT
+
+    def write(self, file_path: str, cached: dict):
+        values = cached['Value']
+        datetimes = values['DateTime'].dt.tz_convert('UTC').dt.tz_localize(None)
+
+        header = json.dumps({
+            'Company'     : cached['Company'],
+            'Stock'       : cached['Stock'],
+            'Rows'        : len(values),
+            'DateTimeUnit': np.datetime_data(datetimes.dtype)[0]
+        }).encode()
+
+        arrays = np.empty((len(self._COLUMNS), len(values)), dtype=np.int64)
+        arrays[0] = values['Timestamp'].to_numpy(dtype=np.int64)
+        arrays[1] = values['Value'].to_numpy(dtype=np.float64).view(np.int64)
+        arrays[2] = datetimes.to_numpy().view(np.int64)
+
+        with open(file_path, 'wb') as f:
+            f.write(self._PREFIX.pack(self._MAGIC, len(header)))
+            f.write(header)
+            f.write(b'\0' * (self._get_data_offset(len(header)) - f.tell()))
+            f.write(arrays.tobytes())
+
+    def read(self, file_path: str, start_date: date = None, end_date: date = None,
+             columns: [str] = None) -> dict:
+        with open(file_path, 'rb') as f:
+            magic, header_size = self._PREFIX.unpack(f.read(self._PREFIX.size))
+            if magic != self._MAGIC:
+                raise ValueError('Not a memory-mapped cache file')
+            header = json.loads(f.read(header_size))
+
+        rows = header['Rows']
+        offset = self._get_data_offset(header_size)
+        shape = (len(self._COLUMNS), rows)
+        if os.path.getsize(file_path) != offset + shape[0] * rows * 8:
+            raise ValueError('Cache file is truncated')
+
+        # Empty files can't be mapped.
+        arrays = np.memmap(file_path, dtype=np.int64, mode='r', offset=offset, shape=shape) \
+            if rows else np.empty(shape, dtype=np.int64)
+
+        # Rows are sorted by timestamp, so the date range is a slice of the mapping.
+        start, stop = 0, rows
+        if start_date is not None and end_date is not None:
+            lower, upper = _get_timestamp_filter(start_date, end_date)
+            start = int(np.searchsorted(arrays[0], lower, side='left'))
+            stop = int(np.searchsorted(arrays[0], upper, side='right'))
+
+        column_values = {
+            'Timestamp': lambda: arrays[0, start:stop],
+            'Value'    : lambda: arrays[1, start:stop].view(np.float64),
+            'DateTime' : lambda: pd.Series(arrays[2, start:stop], copy=False).astype(
+                f'datetime64[{header["DateTimeUnit"]}, UTC]')
+        }
+        values = pd.DataFrame({x: column_values[x]() for x in columns or self._COLUMNS},
+                              copy=False)
+
+        return {'Company': header['Company'], 'Stock': header['Stock'], 'Value': values}
+
+
+# Backend used when none is given, and the backend classes by file extension.
+_DEFAULT_CACHE_BACKEND = PickleCacheBackend()
+_CACHE_BACKEND_CLASSES = {x.extension: x for x in (PickleCacheBackend, ParquetCacheBackend,
+                                                   FeatherCacheBackend,
+                                                   MemoryMappedCacheBackend)}
+
+
+def _get_cache_backend_for_file(file_name: str, cache_backend):
+    """Get the backend that can read the cache file, preferring the given backend."""
+
+    extension = file_name.rsplit('.', 1)[-1]
+    if extension == cache_backend.extension:
+        return cache_backend
+
+    if extension not in _CACHE_BACKEND_CLASSES:
+        raise ValueError(f'Unknown cache file format {file_name}')
+
+    return _CACHE_BACKEND_CLASSES[extension]()
+
+
+def _get_instrument_cache_file_path(instrument_id: str, cache_dir, cache_backend):
+    """Get full file path for the price history cache file of an instrument."""
+    return os.path.join(cache_dir, f'history_{instrument_id}.{cache_backend.extension}')
+
+
+def _normalize_stock_query(instrument_id: str, start_date: any, end_date: any) -> (date, date):
+    """Validate the history query and return the range as dates."""
+
+    if not instrument_id.startswith('HEX'):
+        raise ValueError(f'Invalid instrument name {instrument_id}')
+
+    _validate_dates(start_date, end_date)
+
+    start_date, end_date = [x.date() if isinstance(x, datetime) else x if isinstance(x, date)
+                            else dateutil.parser.parse(x).date() for x in (start_date, end_date)]
+
+    if start_date > end_date:
+        raise ValueError(f'Start date {start_date} is after end date {end_date}')
+
+    return start_date, end_date
+
+
+def _get_last_complete_date() -> date:
+    """
+    Get the last date whose prices can no longer change.
+
+    Cache coverage is only recorded up to this date, so ranges reaching today are refetched.
+    """
+    return pd.Timestamp.now(_EXCHANGE_TIMEZONE).date() - timedelta(days=1)
+
+
+def _merge_date_ranges(ranges: [(date, date)]) -> [(date, date)]:
+    """Merge overlapping and adjacent inclusive date ranges into a sorted list."""
+
+    merged = []
+
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def _get_missing_date_ranges(coverage: [(date, date)], start_date: date, end_date: date) -> [
+    (date, date)]:
+    """Get the parts of the inclusive date range that are not covered by the cached ranges."""
+
+    missing = []
+    current = start_date
+
+    for covered_start, covered_end in coverage:
+        if covered_end < current:
+            continue
+        if covered_start > end_date:
+            break
+        if covered_start > current:
+            missing.append((current, covered_start - timedelta(days=1)))
+        current = max(current, covered_end + timedelta(days=1))
+
+    if current <= end_date:
+        missing.append((current, end_date))
+
+    return missing
+
+
+def _load_cached_stock(catalog_entry, cache_dir, cache_backend, start_date: date = None,
+                       end_date: date = None, columns: [str] = None):
+    """
+    Load the cached price history listed in a catalog entry, or return None if the file is missing.
+
+    When a date range or columns are given, the backend may leave out rows outside the range and
+    other columns.
+    """
+
+    file_name, coverage = catalog_entry
+    file_path = os.path.join(cache_dir, file_name)
+    if not os.path.exists(file_path):
+        _log.warning(f'Cache file {file_name} listed in catalog is missing')
+        return None
+
+    _log.info('Loading from cache')
+
+    backend = _get_cache_backend_for_file(file_name, cache_backend)
+    try:
+        cached = backend.read(file_path, start_date, end_date, columns)
+    except (ValueError, OSError, EOFError, pickle.UnpicklingError) as e:
+        _log.error(f'Ignoring unreadable cache file {file_name}: {e}')
+        return None
+
+    cached['Coverage'] = coverage
+    return cached
+
+
+def _save_cached_stock(cached: dict, instrument_id: str, cache_dir, cache_backend):
+    """Store the price history of an instrument to cache and record its coverage in the catalog."""
+
+    catalog = _get_catalog(cache_dir)
+    previous_entry = catalog.get_history(instrument_id)
+
+    file_path = _get_instrument_cache_file_path(instrument_id, cache_dir, cache_backend)
+    data = {key: value for key, value in cached.items() if key != 'Coverage'}
+
+    _log.info('Storing to cache')
+    _write_atomic(file_path, lambda path: cache_backend.write(path, data))
+
+    file_name = os.path.basename(file_path)
+    catalog.put_history(instrument_id, file_name, cached['Coverage'])
+
+    # Remove the file written by another backend.
+    if previous_entry is not None and previous_entry[0] != file_name:
+        previous_file_path = os.path.join(cache_dir, previous_entry[0])
+        if os.path.exists(previous_file_path):
+            os.remove(previous_file_path)
+
+
+def _get_instrument_lock_path(instrument_id: str, cache_dir):
+    """Get the lock file path guarding updates of the price history of an instrument."""
+    return os.path.join(cache_dir, f'history_{instrument_id}.lock')
+
+
+def _lookup_cached_stock(instrument_id: str, start_date: date, end_date: date, load_from_cache,
+                         save_to_cache, cache_dir, cache_backend, timezone,
+                         columns: [str] = None):
+    """
+    Look up a history query from cache.
+
+    :return: Tuple of the query result if the cache covers the whole date range or None, the
+    cached price history to merge the fetched ranges into, and the missing date ranges.
+    """
+
+    if not load_from_cache and not save_to_cache:
+        return None, None, [(start_date, end_date)]
+
+    memory_key = _get_stock_memory_key(instrument_id, start_date, end_date, cache_dir, timezone,
+                                       columns)
+    if load_from_cache:
+        memory_cached = _get_memory_cached(memory_key)
+        if memory_cached is not None:
+            return memory_cached, None, []
+    else:
+        # The history is about to be refetched, so results kept in memory may become stale.
+        _discard_memory_cached_stock(instrument_id, cache_dir)
+
+    catalog_entry = _get_catalog(cache_dir).get_history(instrument_id)
+    coverage = catalog_entry[1] if catalog_entry is not None and load_from_cache else []
+    missing_ranges = _get_missing_date_ranges(coverage, start_date, end_date)
+
+    if not missing_ranges:
+        # Only the rows and columns of the query need to be read.
+        slice_columns = None if columns is None else \
+            list(dict.fromkeys(columns + ['Timestamp', 'DateTime']))
+        cached = _load_cached_stock(catalog_entry, cache_dir, cache_backend, start_date,
+                                    end_date, slice_columns)
+        if cached is not None:
+            _increment('cache_hits', cache='disk', kind='history')
+            result = _project_stock_result(_slice_cached_stock(cached, start_date, end_date,
+                                                               timezone), columns)
+            _put_memory_cached(memory_key, result)
+            return result, None, []
+
+        missing_ranges = [(start_date, end_date)]
+
+    if load_from_cache:
+        _increment('cache_misses', cache='disk', kind='history')
+
+    # The cached history is also needed when only saving, so that fetched ranges are merged in.
+    cached = _load_cached_stock(catalog_entry, cache_dir, cache_backend) \
+        if catalog_entry is not None else None
+
+    # The coverage of a missing or unreadable file is lost with it, so the whole range is fetched.
+    if catalog_entry is not None and cached is None:
+        missing_ranges = [(start_date, end_date)]
+
+    return None, cached, missing_ranges
+
+
+def _store_fetched_stock(cached: dict, results: [dict], missing_ranges: [(date, date)],
+                         instrument_id: str, start_date: date, end_date: date, save_to_cache,
+                         cache_dir, cache_backend, timezone, columns: [str] = None) -> dict:
+    """Merge fetched query results into the cached history, store it and return the query result."""
+
+    if not save_to_cache:
+        merged = _merge_cached_stock(cached, results, missing_ranges, timezone)
+    else:
+        with _file_lock(_get_instrument_lock_path(instrument_id, cache_dir)):
+            # Another thread or process may have updated the history after it was loaded.
+            catalog_entry = _get_catalog(cache_dir).get_history(instrument_id)
+            loaded_coverage = cached['Coverage'] if cached is not None else None
+            if catalog_entry is not None and catalog_entry[1] != loaded_coverage:
+                # Only the gaps of the history loaded before were fetched, so keep that history
+                # if the updated file can't be read.
+                cached = _load_cached_stock(catalog_entry, cache_dir, cache_backend) or cached
+
+            merged = _merge_cached_stock(cached, results, missing_ranges, timezone)
+            _save_cached_stock(merged, instrument_id, cache_dir, cache_backend)
+
+    result = _project_stock_result(_slice_cached_stock(merged, start_date, end_date, timezone),
+                                   columns)
+
+    if save_to_cache:
+        _put_memory_cached(_get_stock_memory_key(instrument_id, start_date, end_date, cache_dir,
+                                                 timezone, columns), result)
+
+    return result
+
+
+def _project_stock_result(result: dict, columns: [str] = None) -> dict:
+    """Leave only the given columns in the query result DataFrame."""
+
+    if columns is not None:
+        result['Value'] = result['Value'][columns]
+    return result
+
+
+def _convert_timezone(values: pd.DataFrame, timezone) -> pd.DataFrame:
+    """Convert the DateTime column of a price DataFrame to the timezone, if it isn't already."""
+
+    datetimes = values['DateTime']
+    if str(datetimes.dt.tz) == str(timezone):
+        return values
+
+    # Only the DateTime column is replaced, so the other columns can be shared.
+    values = values.copy(deep=False)
+    values['DateTime'] = datetimes.dt.tz_convert(timezone)
+    return values
+
+
+def _merge_cached_stock(cached: dict, results: [dict], fetched_ranges: [(date, date)],
+                        timezone) -> dict:
+    """
+    Merge fetched query results into the cached price history.
+
+    Fetched rows replace cached rows with the same timestamp. Only the parts of the fetched ranges
+    up to the last complete date are added to the coverage.
+    """
+
+    frames = [x['Value'] for x in results]
+    coverage = []
+    company = stock = None
+
+    if cached is not None:
+        frames.insert(0, _convert_timezone(cached['Value'], timezone))
+        coverage = cached['Coverage']
+        company, stock = cached['Company'], cached['Stock']
+
+    if results:
+        company, stock = results[-1]['Company'], results[-1]['Stock']
+
+    values = pd.concat(frames, ignore_index=True)
+    values = values.drop_duplicates(subset='Timestamp', keep='last')
+    values = values.sort_values('Timestamp', ignore_index=True)
+
+    last_complete_date = _get_last_complete_date()
+    fetched_coverage = [(start, min(end, last_complete_date)) for start, end in fetched_ranges
+                        if start <= last_complete_date]
+
+    return {
+        'Company' : company,
+        'Stock'   : stock,
+        'Value'   : values,
+        'Coverage': _merge_date_ranges(coverage + fetched_coverage)
+    }
+
+
+def _slice_cached_stock(cached: dict, start_date: date, end_date: date, timezone) -> dict:
+    """
+    Get the query result for the inclusive date range from the cached price history.
+
+    The range is matched against the days of the exchange timezone, as in the API queries, and the
+    DateTime column is converted to the given timezone. Rows are sorted by time, so the range is
+    taken as a slice without copying the rows.
+    """
+
+    values = _convert_timezone(cached['Value'], timezone)
+    timestamps = values['Timestamp']
+    start = timestamps.searchsorted(pd.Timestamp(start_date, tz=_EXCHANGE_TIMEZONE).timestamp(),
+                                    side='left')
+    stop = timestamps.searchsorted(pd.Timestamp(end_date + timedelta(days=1),
+                                                tz=_EXCHANGE_TIMEZONE).timestamp(), side='left')
+
+    return {
+        'Company': cached['Company'],
+        'Stock'  : cached['Stock'],
+        'Value'  : values.iloc[start:stop].reset_index(drop=True)
+    }
+
+
+def _get_stock_history_params(instrument_id: str, start_date: date, end_date: date) -> dict:
+    """Get the price history query parameters."""
+
+    return {
+        'SubSystem'      : 'History',
+        'Action'         : 'GetChartData',
+        'FromDate'       : start_date.isoformat(),
+        'ToDate'         : end_date.isoformat(),
+        'json'           : True,
+        'showAdjusted'   : True,
+        'app'            : '/osakkeet/historiallisetkurssitiedot-HistoryChar',
+        'DefaultDecimals': False,
         'Instrument'     : instrument_id
     }
 
-    r = requests.get(_API_URL, params)
-    json_result = r.json()
+
+class _ChartDataDecoder:
+    """
+    Incremental decoder of the GetChartData JSON response.
+
+    The numeric "cp" arrays are parsed chunk by chunk straight into float64 NumPy arrays, without
+    creating a Python object per row. The rest of the document is small and decoded with json, with
+    every "cp" array replaced by its (rows, columns) NumPy array.
+    """
+
+    _ARRAY_START = re.compile(rb'"cp"\s*:\s*\[')
+    _ARRAY_END = re.compile(rb'\]\s*\]')
+
+    # Longest possible partial array start kept between chunks.
+    _START_TAIL_SIZE = 64
+
+    # Separators between the numbers, replaced with spaces before parsing.
+    _SEPARATORS = bytes.maketrans(b'[],', b'   ')
+
+    def __init__(self):
+        self._document = []
+        self._arrays = []
+        self._buffer = b''
+        self._array_parts = None
+        self._array_rows = 0
+        self._bytes = 0
+        self._parse_seconds = 0.0
+
+    def feed(self, data: bytes):
+        """Feed a chunk of the response."""
+
+        start = time.perf_counter()
+        buffer = self._buffer + data
+
+        while True:
+            if self._array_parts is None:
+                m = self._ARRAY_START.search(buffer)
+                if m is None:
+                    split = max(0, len(buffer) - self._START_TAIL_SIZE)
+                    self._document.append(buffer[:split])
+                    buffer = buffer[split:]
+                    break
+
+                self._document.append(buffer[:m.end()])
+                buffer = buffer[m.end():]
+                self._array_parts = []
+                self._array_rows = 0
+                continue
+
+            stripped = buffer.lstrip()
+            if self._array_rows == 0 and stripped[:1] == b']':
+                # Empty array.
+                buffer = stripped[1:]
+                self._finish_array()
+                continue
+
+            m = self._ARRAY_END.search(buffer)
+            if m is not None:
+                self._parse_numbers(buffer[:m.start() + 1])
+                buffer = buffer[m.end():]
+                self._finish_array()
+                continue
+
+            # Parse the complete rows, keep the last row which may be incomplete.
+            split = buffer.rfind(b'[')
+            if split > 0:
+                self._parse_numbers(buffer[:split])
+                buffer = buffer[split:]
+            break
+
+        self._buffer = buffer
+        self._bytes += len(data)
+        self._parse_seconds += time.perf_counter() - start
+
+    def close(self) -> dict:
+        """Finish decoding and return the decoded response."""
+
+        if self._array_parts is not None:
+            raise ValueError('Unexpected end of chart data')
+
+        start = time.perf_counter()
+        self._document.append(self._buffer)
+        result = json.loads(b''.join(self._document))
+
+        arrays = iter(self._arrays)
+        self._replace_arrays(result, arrays)
+
+        self._parse_seconds += time.perf_counter() - start
+        _increment('http_response_bytes', self._bytes, action='GetChartData')
+        _observe('parse_seconds', self._parse_seconds, kind='chart_data')
+
+        return result
+
+    def _parse_numbers(self, data: bytes):
+        rows = data.count(b'[')
+        if rows == 0:
+            return
+
+        numbers = np.fromstring(data.translate(self._SEPARATORS).replace(b'null', b'nan'),
+                                dtype=np.float64, sep=' ')
+        if len(numbers) % rows != 0:
+            raise ValueError('Invalid chart data row')
+
+        self._array_parts.append(numbers.reshape(rows, -1))
+        self._array_rows += rows
+
+    def _finish_array(self):
+        parts = self._array_parts
+        self._arrays.append(np.concatenate(parts) if parts else np.empty((0, 2)))
+        self._document.append(b']')
+        self._array_parts = None
+
+    def _replace_arrays(self, value, arrays):
+        # Dicts keep the document order, so the arrays are found in the order they were parsed.
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key == 'cp' and item == []:
+                    value[key] = next(arrays)
+                else:
+                    self._replace_arrays(item, arrays)
+        elif isinstance(value, list):
+            for item in value:
+                self._replace_arrays(item, arrays)
+
+
+def _decode_chart_data_response(chunks) -> dict:
+    """Decode the GetChartData JSON response from an iterable of byte chunks."""
+
+    decoder = _ChartDataDecoder()
+
+    for chunk in chunks:
+        decoder.feed(chunk)
+
+    return decoder.close()
+
+
+def _parse_stock_history_entry(json_data: dict, timezone) -> dict:
+    """Parse one instrument entry of the history response into company info and price DataFrame."""
+
+    json_stock_name = json_data['instData']['@nm']
+    json_company_name = json_data['instData']['@fnm']
+
+    with _timer('parse_seconds', kind='history'):
+        json_stock_value = np.asarray(json_data['chartData']['cp'], dtype=np.float64).reshape(
+            -1, 2)
+
+        # Create the stock DataFrame with epoch timestamp and datetime columns.
+        timestamps = json_stock_value[:, 0].astype(np.int64) // 1000
+        pd_stock_value = pd.DataFrame({
+            'Timestamp': timestamps,
+            'Value'    : json_stock_value[:, 1],
+            'DateTime' : pd.to_datetime(timestamps, unit='s', utc=True).tz_convert(timezone)
+        })
+
+    _increment('rows', len(pd_stock_value), kind='history')
+
+    return {
+        'Company': json_company_name,
+        'Stock'  : json_stock_name,
+        'Value'  : pd_stock_value
+    }
+
+
+def _parse_stock_history_response(json_result: dict, instrument_id: str, timezone) -> dict:
+    """
+    Parse the JSON history response into company information and price DataFrame.
+
+    The price rows may be either lists, as decoded by json, or a NumPy array.
+    """
+
+    status = int(json_result['@status'])
+    if status != 1:
+        raise ValueError(f'Invalid status {status} or instrument {instrument_id}')
+
+    return _parse_stock_history_entry(json_result['data'][0], timezone)
+
+
+def _parse_stock_history_responses(json_result: dict, instrument_ids: [str], timezone) -> dict:
+    """
+    Parse the JSON history response of several instruments.
+
+    Entries are matched to the instruments by their id attribute, or by position if the entries
+    have no ids.
+
+    :return: Dictionary of instrument identifier to company information and price DataFrame, for
+    the instruments found in the response.
+    """
+
     status = int(json_result['@status'])
     if status != 1:
-        raise ValueError(f'Invalid status {status} or instrument {instrument_id}')
+        raise ValueError(f'Invalid status {status} or instruments {",".join(instrument_ids)}')
 
-    json_data = json_result['data'][0]
-    json_stock_name = json_data['instData']['@nm']
-    json_company_name = json_data['instData']['@fnm']
+    entries = json_result['data']
 
-    json_stock_value = json_data['chartData']['cp']
+    if all('@id' in x['instData'] for x in entries):
+        return {x['instData']['@id']: _parse_stock_history_entry(x, timezone) for x in entries
+                if x['instData']['@id'] in instrument_ids}
 
-    # Create the stock DataFrame.
-    pd_stock_value = pd.DataFrame(json_stock_value, columns=['Timestamp', 'Value'])
+    if len(entries) != len(instrument_ids):
+        raise ValueError(f'Expected {len(instrument_ids)} instruments in response, got '
+                         f'{len(entries)}')
 
-    # Create epoch timestamp and datetime columns.
-    timestamps = pd_stock_value['Timestamp'].values // 1000
-    pd_stock_value.loc[:, 'Timestamp'] = timestamps
-    timestamps_dt = [datetime.fromtimestamp(x) for x in timestamps]
-    pd_stock_value['DateTime'] = pd.to_datetime(timestamps_dt)
+    return {instrument_id: _parse_stock_history_entry(x, timezone) for instrument_id, x in
+            zip(instrument_ids, entries)}
+
+
+class _SingleFlight:
+    """
+    Deduplicates concurrent calls of the same function by key.
+
+    While a call with a key is running, other threads calling with the same key wait for it and get
+    a copy of its result, or its exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """Call fn, or wait for the running call with the same key, and return the result."""
+
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            return _copy_cached_value(future.result())
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class _AsyncSingleFlight:
+    """
+    Asyncio version of _SingleFlight.
+
+    Tasks awaiting the same key on the same event loop share one call of the coroutine function.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, coroutine_fn):
+        """Await coroutine_fn(), or the running call with the same key, and return the result."""
+
+        key = (id(asyncio.get_running_loop()), key)
+
+        future = self._calls.get(key)
+        while future is not None:
+            try:
+                return _copy_cached_value(await asyncio.shield(future))
+            except asyncio.CancelledError:
+                # Only the running call was cancelled, not this task, so make the call again.
+                if not future.cancelled():
+                    raise
+            future = self._calls.get(key)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+
+        try:
+            result = await coroutine_fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Retrieve the exception, so an unawaited future doesn't log it.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
 
-    result = {
-        'Company': json_company_name,
-        'Stock'  : json_stock_name,
-        'Value'  : pd_stock_value
-    }
+
+_single_flight = _SingleFlight()
+_async_single_flight = _AsyncSingleFlight()
+
+
+def _get_stock_query_key(instrument_id: str, start_date: date, end_date: date, load_from_cache,
+                         save_to_cache, cache_dir, cache_backend, timezone, columns: [str] = None):
+    """Get the key identifying identical history queries."""
+
+    return ('history', instrument_id, start_date, end_date, load_from_cache, save_to_cache,
+            os.path.abspath(cache_dir), cache_backend.extension, str(timezone),
+            tuple(columns) if columns is not None else None)
+
+
+def _get_market_query_key(markets: [Markets], load_from_cache, save_to_cache, cache_dir):
+    """Get the key identifying identical instrument list queries."""
+
+    return ('instruments', _get_markets_key(markets), load_from_cache, save_to_cache,
+            os.path.abspath(cache_dir))
+
+
+def _query_stock(instrument_id: str, start_date: date, end_date: date, load_from_cache,
+                 save_to_cache, cache_dir, cache_backend, timezone, columns: [str],
+                 client: DataFeedClient) -> dict:
+    """Load a history query from cache, fetching and storing the missing date ranges."""
+
+    result, cached, missing_ranges = _lookup_cached_stock(instrument_id, start_date, end_date,
+                                                          load_from_cache, save_to_cache,
+                                                          cache_dir, cache_backend, timezone,
+                                                          columns)
+    if result is not None:
+        return result
+
+    _log.info(f'Fetching {len(missing_ranges)} missing date ranges for {instrument_id}')
+
+    client = client or get_default_client()
+    results = []
+
+    for range_start, range_end in missing_ranges:
+        params = _get_stock_history_params(instrument_id, range_start, range_end)
+
+        with client.get(params, stream=True) as r:
+            json_result = _decode_chart_data_response(r.iter_content(chunk_size=_CHUNK_SIZE))
+
+        results.append(_parse_stock_history_response(json_result, instrument_id, timezone))
+
+    return _store_fetched_stock(cached, results, missing_ranges, instrument_id, start_date,
+                                end_date, save_to_cache, cache_dir, cache_backend, timezone,
+                                columns)
+
+
+def _query_market_instruments(markets: [Markets], load_from_cache, save_to_cache, cache_dir,
+                              client: DataFeedClient) -> InstrumentTable:
+    """Load the instrument list from cache, or fetch and store it."""
+
+    # Load instrument list from cache if they were loaded for this date.
+    if load_from_cache:
+        cached_data = _load_cached_instrument_list(markets, cache_dir)
+        if cached_data is not None:
+            return cached_data
+
+    _log.debug('Fetching and parsing stock XML')
+    with _fetch_stock_page(*markets, client=client) as stock_page:
+        instruments = _parse_stock_instruments_response(stock_page)
 
     if save_to_cache:
-        _log.info('Storing to cache')
-        with open(file_path, 'wb+') as f:
-            pickle.dump(result, f)
+        _save_cached_instrument_list(instruments, markets, cache_dir)
+
+    return instruments
+
+
+def _query_stocks_batched(instrument_ids: [str], start_date: date, end_date: date,
+                          load_from_cache, save_to_cache, cache_dir, cache_backend, timezone,
+                          columns: [str], client: DataFeedClient, max_workers,
+                          batch_size) -> dict:
+    """
+    Load history queries of many instruments from cache, fetching the missing date ranges of up to
+    batch_size instruments per request.
+
+    Instruments are batched together when they miss the same date ranges. Instruments left out of
+    a batched response are fetched one by one.
+
+    :return: Dictionary of instrument identifier to query result.
+    """
+
+    def lookup(instrument_id):
+        return _lookup_cached_stock(instrument_id, start_date, end_date, load_from_cache,
+                                    save_to_cache, cache_dir, cache_backend, timezone, columns)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        lookups = dict(zip(instrument_ids, executor.map(lookup, instrument_ids)))
+
+    query_results = {x: lookups[x][0] for x in instrument_ids if lookups[x][0] is not None}
+
+    # Group the instruments by their missing date ranges and split the groups into batches.
+    groups = defaultdict(list)
+    for instrument_id, (result, cached, missing_ranges) in lookups.items():
+        if result is None:
+            groups[tuple(missing_ranges)].append(instrument_id)
+
+    requests_to_make = [(batch, missing_range) for missing_ranges, group_ids in groups.items()
+                        for i in range(0, len(group_ids), batch_size)
+                        for batch in [group_ids[i:i + batch_size]]
+                        for missing_range in missing_ranges]
+
+    client = client or get_default_client()
+
+    def fetch(request):
+        batch, (range_start, range_end) = request
+        _log.info(f'Fetching {range_start} - {range_end} for {len(batch)} instruments')
+
+        params = _get_stock_history_params(','.join(batch), range_start, range_end)
+        with client.get(params, stream=True) as r:
+            json_result = _decode_chart_data_response(r.iter_content(chunk_size=_CHUNK_SIZE))
+
+        batch_results = _parse_stock_history_responses(json_result, batch, timezone)
+
+        for instrument_id in batch:
+            if instrument_id not in batch_results:
+                _log.warning(f'Instrument {instrument_id} missing from batch, fetching it alone')
+                params = _get_stock_history_params(instrument_id, range_start, range_end)
+                with client.get(params, stream=True) as r:
+                    json_result = _decode_chart_data_response(
+                        r.iter_content(chunk_size=_CHUNK_SIZE))
+                batch_results[instrument_id] = _parse_stock_history_response(
+                    json_result, instrument_id, timezone)
+
+        return batch_results
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fetched = list(executor.map(fetch, requests_to_make))
+
+    # Collect the fetched ranges of every instrument, in the order of its missing ranges.
+    fetched_results = defaultdict(list)
+    for batch_results in fetched:
+        for instrument_id, result in batch_results.items():
+            fetched_results[instrument_id].append(result)
+
+    def store(instrument_id):
+        result, cached, missing_ranges = lookups[instrument_id]
+        return _store_fetched_stock(cached, fetched_results[instrument_id], missing_ranges,
+                                    instrument_id, start_date, end_date, save_to_cache,
+                                    cache_dir, cache_backend, timezone, columns)
+
+    fetched_ids = [x for x in instrument_ids if x not in query_results]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        query_results.update(zip(fetched_ids, executor.map(store, fetched_ids)))
+
+    return query_results
+
+
+@_measure_query
+def get_stock_df(instrument_id: str
+                 , start_date: any
+                 , end_date: any
+                 , load_from_cache=True
+                 , save_to_cache=True
+                 , cache_dir=_DEFAULT_CACHE_DIR
+                 , return_only_df=True
+                 , client: DataFeedClient = None
+                 , cache_backend=None
+                 , columns: [str] = None
+                 , timezone=_DEFAULT_TIMEZONE):
+    """
+    Query price history for a specific market item (stock).
+
+    :param instrument_id: Instrument identifier, as returned by the market instrument query.
+    :param start_date: Price date range start as ISO date string or datetime object.
+    :param end_date: Price date range end as ISO date string or datetime object.
+    :param load_from_cache: If true, load the cached parts of the date range from cache and fetch
+    only the missing parts.
+    :param save_to_cache: If true, merge the fetched date ranges into the instrument cache file.
+    :param cache_dir: Cache directory.
+    :param return_only_df: If true, return only the DataFrame without company info.
+    :param client: Client used for the API query, defaults to the shared default client.
+    :param cache_backend: Cache file format backend, e.g. ParquetCacheBackend, defaults to pickle.
+    :param columns: If given, return only these DataFrame columns.
+    :param timezone: Timezone of the DateTime column. The date range is matched in the days of the
+    exchange, Europe/Helsinki, whatever the timezone.
+    :return: Dictionary containing company information and Pandas DataFrame containing the stock
+    price from the provided
+    date range.
+    """
+
+    start_date, end_date = _normalize_stock_query(instrument_id, start_date, end_date)
+
+    if load_from_cache or save_to_cache:
+        _create_dir_if_not_exists(cache_dir)
+
+    cache_backend = cache_backend or _DEFAULT_CACHE_BACKEND
+
+    # Concurrent identical queries share one lookup and fetch.
+    key = _get_stock_query_key(instrument_id, start_date, end_date, load_from_cache,
+                               save_to_cache, cache_dir, cache_backend, timezone, columns)
+    result = _single_flight.do(key, lambda: _query_stock(instrument_id, start_date, end_date,
+                                                         load_from_cache, save_to_cache,
+                                                         cache_dir, cache_backend, timezone,
+                                                         columns, client))
 
     return result['Value'] if return_only_df else result
 
 
+@_measure_query
+def get_stock_dfs(instrument_ids: [str]
+                  , start_date: any
+                  , end_date: any
+                  , load_from_cache=True
+                  , save_to_cache=True
+                  , cache_dir=_DEFAULT_CACHE_DIR
+                  , max_workers=_DEFAULT_POOL_SIZE
+                  , long_format=False
+                  , client: DataFeedClient = None
+                  , cache_backend=None
+                  , columns: [str] = None
+                  , timezone=_DEFAULT_TIMEZONE
+                  , batch_size=1):
+    """
+    Query price history for many instruments concurrently.
+
+    Every instrument goes through the same cache lookup as get_stock_df, so only the cache misses
+    are fetched from the API, at most max_workers at a time.
+
+    :param instrument_ids: Instrument identifiers, as returned by the market instrument query.
+    :param start_date: Price date range start as ISO date string or datetime object.
+    :param end_date: Price date range end as ISO date string or datetime object.
+    :param load_from_cache: If true, load the cached parts of the date range from cache and fetch
+    only the missing parts.
+    :param save_to_cache: If true, merge the fetched date ranges into the instrument cache files.
+    :param cache_dir: Cache directory.
+    :param max_workers: Maximum number of concurrent queries, keep this at most the client pool size.
+    :param long_format: If true, return a single DataFrame with an Instrument column instead of a
+    dictionary.
+    :param client: Client used for the API queries, defaults to the shared default client.
+    :param cache_backend: Cache file format backend, e.g. ParquetCacheBackend, defaults to pickle.
+    :param columns: If given, return only these DataFrame columns.
+    :param timezone: Timezone of the DateTime column. The date range is matched in the days of the
+    exchange, Europe/Helsinki, whatever the timezone.
+    :param batch_size: If greater than one, fetch the missing date ranges of up to this many
+    instruments in a single request.
+    :return: Dictionary of instrument identifier to Pandas DataFrame, or a single long format
+    DataFrame.
+    """
+
+    instrument_ids = list(dict.fromkeys(instrument_ids))
+    if len(instrument_ids) == 0:
+        raise ValueError('No instruments given')
+
+    _validate_dates(start_date, end_date)
+
+    if load_from_cache or save_to_cache:
+        _create_dir_if_not_exists(cache_dir)
+
+    client = client or get_default_client()
+
+    if batch_size > 1:
+        start_date, end_date = _normalize_stock_query(instrument_ids[0], start_date, end_date)
+        for instrument_id in instrument_ids:
+            _normalize_stock_query(instrument_id, start_date, end_date)
+
+        results = _query_stocks_batched(instrument_ids, start_date, end_date, load_from_cache,
+                                        save_to_cache, cache_dir,
+                                        cache_backend or _DEFAULT_CACHE_BACKEND, timezone,
+                                        columns, client, max_workers, batch_size)
+        frames = {x: results[x]['Value'] for x in instrument_ids}
+    else:
+        def fetch(instrument_id):
+            return get_stock_df(instrument_id, start_date, end_date,
+                                load_from_cache=load_from_cache,
+                                save_to_cache=save_to_cache,
+                                cache_dir=cache_dir,
+                                client=client,
+                                cache_backend=cache_backend,
+                                columns=columns,
+                                timezone=timezone)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            frames = dict(zip(instrument_ids, executor.map(fetch, instrument_ids)))
+
+    if not long_format:
+        return frames
+
+    return pd.concat(frames, names=['Instrument']).reset_index(level=0).reset_index(drop=True)
+
+
+@_measure_query
+def get_price_panel(instrument_ids: [str]
+                    , start_date: any
+                    , end_date: any
+                    , daily=False
+                    , load_from_cache=True
+                    , save_to_cache=True
+                    , cache_dir=_DEFAULT_CACHE_DIR
+                    , max_workers=_DEFAULT_POOL_SIZE
+                    , client: DataFeedClient = None
+                    , cache_backend=None
+                    , timezone=_DEFAULT_TIMEZONE
+                    , batch_size=1):
+    """
+    Query price history for many instruments as one date aligned price matrix.
+
+    The histories are queried concurrently with get_stock_dfs and aligned on the sorted union of
+    their times, without merging the DataFrames one by one.
+
+    :param instrument_ids: Instrument identifiers, as returned by the market instrument query.
+    :param start_date: Price date range start as ISO date string or datetime object.
+    :param end_date: Price date range end as ISO date string or datetime object.
+    :param daily: If true, keep only the last price of every date, indexed by the date at
+    midnight.
+    :param load_from_cache: If true, load the cached parts of the date range from cache and fetch
+    only the missing parts.
+    :param save_to_cache: If true, merge the fetched date ranges into the instrument cache files.
+    :param cache_dir: Cache directory.
+    :param max_workers: Maximum number of concurrent queries, keep this at most the client pool
+    size.
+    :param client: Client used for the API queries, defaults to the shared default client.
+    :param cache_backend: Cache file format backend, e.g. ParquetCacheBackend, defaults to pickle.
+    :param timezone: Timezone of the DateTime index, the dates of daily prices are matched in this
+    timezone. The date range is matched in the days of the exchange, Europe/Helsinki.
+    :param batch_size: If greater than one, fetch the missing date ranges of up to this many
+    instruments in a single request.
+    :return: Pandas DataFrame with a DateTime index and a column of prices per instrument, NaN where
+    an instrument has no price.
+    """
+
+    frames = get_stock_dfs(instrument_ids, start_date, end_date,
+                           load_from_cache=load_from_cache,
+                           save_to_cache=save_to_cache,
+                           cache_dir=cache_dir,
+                           max_workers=max_workers,
+                           client=client,
+                           cache_backend=cache_backend,
+                           timezone=timezone,
+                           batch_size=batch_size)
+
+    # Integer keys of the rows of every instrument, Unix seconds or local dates as days since the
+    # epoch. The histories are sorted by time, so the last row of a date is its closing price.
+    keys = []
+    values = []
+    for frame in frames.values():
+        if daily:
+            days = frame['DateTime'].dt.tz_localize(None).to_numpy().astype('datetime64[D]')
+            last = np.append(days[1:] != days[:-1], True) if len(days) > 0 else \
+                np.zeros(0, dtype=bool)
+            keys.append(days[last].astype(np.int64))
+            values.append(frame['Value'].to_numpy()[last])
+        else:
+            keys.append(frame['Timestamp'].to_numpy(dtype=np.int64))
+            values.append(frame['Value'].to_numpy())
+
+    index = np.unique(np.concatenate(keys))
+
+    # Fill a column per instrument, stored as rows of the array so that every column of the
+    # DataFrame is contiguous and the array is used without copying.
+    prices = np.full((len(frames), len(index)), np.nan)
+    for i, (instrument_keys, instrument_values) in enumerate(zip(keys, values)):
+        prices[i, np.searchsorted(index, instrument_keys)] = instrument_values
+
+    if daily:
+        datetimes = pd.DatetimeIndex(index.astype('datetime64[D]').astype('datetime64[s]'))
+        datetimes = datetimes.tz_localize(timezone)
+    else:
+        datetimes = pd.DatetimeIndex(index.astype('datetime64[s]')).tz_localize('UTC')
+        datetimes = datetimes.tz_convert(timezone)
+
+    return pd.DataFrame(prices.T, index=datetimes.rename('DateTime'),
+                        columns=pd.Index(list(frames), name='Instrument'), copy=False)
+
+
+@_measure_query
 def get_market_instruments(markets: [Markets]
                            , load_from_cache=True
                            , save_to_cache=True
                            , cache_dir=_DEFAULT_CACHE_DIR
-                           , return_dict=False):
+                           , return_dict=False
+                           , return_format='objects'
+                           , client: DataFeedClient = None):
     """
     Get the market instruments from the provided markets.
 
@@ -359,45 +3007,681 @@ def get_market_instruments(markets: [Markets]
     :param load_from_cache: True if the result can be loaded from cache.
     :param save_to_cache: True if result of query is saved to cache.
     :param cache_dir: Cache directory.
-    :param return_dict: If true, return raw dict, if false return MarketInstrument objects.
-    :return: List of market instruments parsed from the API response.
+    :param return_dict: If true, return raw dicts, if false return MarketInstrument objects.
+    Same as return_format='dicts'.
+    :param return_format: 'objects' to return MarketInstrument objects, 'dicts' to return raw
+    dicts, 'table' to return an InstrumentTable or 'frame' to return a Pandas DataFrame. Prices and
+    volumes of raw dicts are the attribute values of the API response, otherwise they are floats,
+    NaN when missing.
+    :param client: Client used for the API query, defaults to the shared default client.
+    :return: Market instruments parsed from the API response, in the requested format.
     """
 
     if not isinstance(markets, list):
         raise ValueError(f'Markets must be a list, not {type(markets)}')
 
+    if return_format not in _INSTRUMENT_FORMATS:
+        raise ValueError(f'Invalid return format {return_format}')
+
+    if return_dict:
+        return_format = 'dicts'
+
     if load_from_cache or save_to_cache:
         _create_dir_if_not_exists(cache_dir)
 
-    # Load instrument list from cache if they were loaded for this date.
+    # Concurrent identical queries share one lookup and fetch.
+    key = _get_market_query_key(markets, load_from_cache, save_to_cache, cache_dir)
+    instruments = _single_flight.do(key, lambda: _query_market_instruments(
+        markets, load_from_cache, save_to_cache, cache_dir, client))
+
+    # Return dict or convert the dicts into MarketInstrument objects or a table.
+    return _convert_instruments(instruments, return_format)
+
+
+async def _async_query_stock(instrument_id: str, start_date: date, end_date: date,
+                             load_from_cache, save_to_cache, cache_dir, cache_backend, timezone,
+                             columns: [str], client: AsyncDataFeedClient) -> dict:
+    """Asyncio version of _query_stock, cache files are read and written on worker threads."""
+
+    result, cached, missing_ranges = await asyncio.to_thread(
+        _lookup_cached_stock, instrument_id, start_date, end_date, load_from_cache, save_to_cache,
+        cache_dir, cache_backend, timezone, columns)
+    if result is not None:
+        return result
+
+    async def read_chart_data(r):
+        decoder = _ChartDataDecoder()
+
+        async for chunk in r.content.iter_chunked(_CHUNK_SIZE):
+            decoder.feed(chunk)
+
+        return decoder.close()
+
+    client = client or get_default_async_client()
+    json_results = await asyncio.gather(
+        *[client.request(_get_stock_history_params(instrument_id, range_start, range_end),
+                         read_chart_data)
+          for range_start, range_end in missing_ranges])
+    results = [_parse_stock_history_response(x, instrument_id, timezone) for x in json_results]
+
+    return await asyncio.to_thread(_store_fetched_stock, cached, results, missing_ranges,
+                                   instrument_id, start_date, end_date, save_to_cache, cache_dir,
+                                   cache_backend, timezone, columns)
+
+
+async def _async_query_market_instruments(markets: [Markets], load_from_cache, save_to_cache,
+                                          cache_dir,
+                                          client: AsyncDataFeedClient) -> InstrumentTable:
+    """Asyncio version of _query_market_instruments."""
+
     if load_from_cache:
-        cached_instruments = _get_cached_instrument_list(markets, datetime.now(), cache_dir)
-        if cached_instruments is not None:
-            _log.info('Loading from cache')
+        cached_data = await asyncio.to_thread(_load_cached_instrument_list, markets, cache_dir)
+        if cached_data is not None:
+            return cached_data
+
+    params = _get_market_params(markets)
 
-            cached_instruments_full_path = os.path.join(cache_dir, cached_instruments)
+    async def read_instruments(r):
+        parser = _StockInstrumentParser()
 
-            with open(cached_instruments_full_path, 'rb') as f:
-                cached_data = pickle.load(f)
-                return cached_data if return_dict else [MarketInstrument.from_json_result(x) for x
-                                                        in
-                                                        cached_data]
+        async for chunk in r.content.iter_chunked(_CHUNK_SIZE):
+            parser.feed(chunk)
 
-    _log.debug('Fetching stock XML')
-    stock_page = _fetch_stock_page(*markets)
+        return parser.close()
 
-    _log.debug('Parsing instruments')
-    instruments = _parse_stock_instruments_response(stock_page)
+    _log.debug('Fetching and parsing stock XML')
+    client = client or get_default_async_client()
+    instruments = await client.request(params, read_instruments)
 
     if save_to_cache:
-        _log.debug('Storing instruments for this date')
-        cached_instruments_filename = _get_instrument_list_filename(markets, datetime.now())
+        await asyncio.to_thread(_save_cached_instrument_list, instruments, markets, cache_dir)
+
+    return instruments
+
+
+@_measure_query
+async def async_get_stock_df(instrument_id: str
+                             , start_date: any
+                             , end_date: any
+                             , load_from_cache=True
+                             , save_to_cache=True
+                             , cache_dir=_DEFAULT_CACHE_DIR
+                             , return_only_df=True
+                             , client: AsyncDataFeedClient = None
+                             , cache_backend=None
+                             , columns: [str] = None
+                             , timezone=_DEFAULT_TIMEZONE):
+    """
+    Asyncio version of get_stock_df, cache files are read and written on worker threads.
+
+    :param client: Asyncio client used for the API query, defaults to the default asyncio client.
+    :return: Same as get_stock_df.
+    """
+
+    start_date, end_date = _normalize_stock_query(instrument_id, start_date, end_date)
+
+    if load_from_cache or save_to_cache:
+        _create_dir_if_not_exists(cache_dir)
+
+    cache_backend = cache_backend or _DEFAULT_CACHE_BACKEND
+
+    key = _get_stock_query_key(instrument_id, start_date, end_date, load_from_cache,
+                               save_to_cache, cache_dir, cache_backend, timezone, columns)
+    result = await _async_single_flight.do(
+        key, lambda: _async_query_stock(instrument_id, start_date, end_date, load_from_cache,
+                                        save_to_cache, cache_dir, cache_backend, timezone,
+                                        columns, client))
+
+    return result['Value'] if return_only_df else result
+
+
+@_measure_query
+async def async_get_market_instruments(markets: [Markets]
+                                       , load_from_cache=True
+                                       , save_to_cache=True
+                                       , cache_dir=_DEFAULT_CACHE_DIR
+                                       , return_dict=False
+                                       , return_format='objects'
+                                       , client: AsyncDataFeedClient = None):
+    """
+    Asyncio version of get_market_instruments, cache files are read and written on worker threads.
+
+    :param client: Asyncio client used for the API query, defaults to the default asyncio client.
+    :return: Same as get_market_instruments.
+    """
+
+    if not isinstance(markets, list):
+        raise ValueError(f'Markets must be a list, not {type(markets)}')
+
+    if return_format not in _INSTRUMENT_FORMATS:
+        raise ValueError(f'Invalid return format {return_format}')
+
+    if return_dict:
+        return_format = 'dicts'
+
+    if load_from_cache or save_to_cache:
+        _create_dir_if_not_exists(cache_dir)
+
+    key = _get_market_query_key(markets, load_from_cache, save_to_cache, cache_dir)
+    instruments = await _async_single_flight.do(key, lambda: _async_query_market_instruments(
+        markets, load_from_cache, save_to_cache, cache_dir, client))
+
+    return _convert_instruments(instruments, return_format)
+
+
+class PrefetchScheduler:
+    """
+    Keeps the caches of a watchlist of markets and instruments warm on a background thread.
+
+    The watchlist is refreshed when the scheduler starts, every interval seconds after that, and
+    shortly after midnight, when the daily instrument lists expire and the previous day's prices
+    become complete. Foreground queries of the watchlist then find their results in cache.
+    """
+
+    def __init__(self
+                 , markets: [Markets] = None
+                 , instrument_ids: [str] = None
+                 , history_days=365
+                 , interval=3600
+                 , midnight_delay=60
+                 , cache_dir=_DEFAULT_CACHE_DIR
+                 , cache_backend=None
+                 , timezone=_DEFAULT_TIMEZONE
+                 , max_workers=_DEFAULT_POOL_SIZE
+                 , batch_size=1
+                 , client: DataFeedClient = None):
+        """
+        Create a new scheduler, call start to begin refreshing.
+
+        :param markets: Markets whose instrument lists are refreshed.
+        :param instrument_ids: Instruments whose price histories are refreshed.
+        :param history_days: Number of days of price history kept cached, up to the current date.
+        :param interval: Maximum number of seconds between refreshes.
+        :param midnight_delay: Number of seconds after midnight to run the daily refresh at.
+        :param cache_dir: Cache directory.
+        :param cache_backend: Cache file format backend, defaults to pickle.
+        :param timezone: Timezone of the DateTime column of the cached histories.
+        :param max_workers: Maximum number of concurrent history queries.
+        :param batch_size: Number of instruments fetched in a single request, see get_stock_dfs.
+        :param client: Client used for the API queries, defaults to the shared default client.
+        """
+
+        if not markets and not instrument_ids:
+            raise ValueError('No markets or instruments given')
+
+        if interval <= 0:
+            raise ValueError(f'Invalid interval {interval}')
+
+        self.markets = list(markets or [])
+        self.instrument_ids = list(instrument_ids or [])
+        self.history_days = history_days
+        self.interval = interval
+        self.midnight_delay = midnight_delay
+        self.cache_dir = cache_dir
+        self.cache_backend = cache_backend
+        self.timezone = timezone
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.client = client
+
+        # Time of the last refresh that completed without errors.
+        self.last_refresh = None
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def refresh(self) -> bool:
+        """
+        Refresh the whole watchlist once in the calling thread.
+
+        :return: True if everything was refreshed, failures are logged.
+        """
+
+        success = True
+
+        if self.markets:
+            try:
+                get_market_instruments(self.markets, cache_dir=self.cache_dir,
+                                       return_format='table', client=self.client)
+            except Exception:
+                _log.exception('Refreshing market instruments failed')
+                success = False
+
+        if self.instrument_ids:
+            end_date = date.today()
+            try:
+                get_stock_dfs(self.instrument_ids, end_date - timedelta(days=self.history_days),
+                              end_date, cache_dir=self.cache_dir, max_workers=self.max_workers,
+                              client=self.client, cache_backend=self.cache_backend,
+                              timezone=self.timezone, batch_size=self.batch_size)
+            except Exception:
+                _log.exception('Refreshing price histories failed')
+                success = False
+
+        if success:
+            self.last_refresh = datetime.now()
+
+        return success
+
+    def start(self):
+        """Start refreshing on a daemon thread."""
+
+        if self.is_running():
+            raise RuntimeError('Scheduler is already running')
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='PrefetchScheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop refreshing and wait for a refresh in progress to finish."""
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _get_wait_time(self) -> float:
+        """Get the number of seconds until the next refresh."""
+
+        now = datetime.now()
+        next_daily_refresh = datetime.combine(now.date(), datetime.min.time()) + timedelta(
+            seconds=self.midnight_delay)
+        if next_daily_refresh <= now:
+            next_daily_refresh += timedelta(days=1)
+
+        return min(self.interval, (next_daily_refresh - now).total_seconds())
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            _log.debug('Refreshing watchlist')
+            self.refresh()
+            self._stop_event.wait(self._get_wait_time())
+
+
+class QuoteUpdate:
+    """Result of a quote poll: the instruments whose quotes changed since the previous poll."""
+
+    __slots__ = ('time', 'changed', 'removed', 'snapshot')
+
+    def __init__(self, time: pd.Timestamp, changed: InstrumentTable, removed: [str],
+                 snapshot: InstrumentTable):
+        # UTC time of the poll.
+        self.time = time
+        # Instruments that are new or whose bid, ask, last price or volume changed.
+        self.changed = changed
+        # Identifiers of the instruments no longer listed.
+        self.removed = removed
+        # All instruments listed in the poll.
+        self.snapshot = snapshot
+
+    def __repr__(self) -> str:
+        return f'QuoteUpdate({self.time}, {len(self.changed)} changed, {len(self.removed)} removed)'
+
+
+class QuotePoller:
+    """
+    Polls the instrument lists of markets and reports the instruments whose quotes changed.
+
+    The previous poll is kept as an InstrumentTable and compared with the next one column-wise, so
+    no object is created per instrument. When the server sends an ETag or Last-Modified header,
+    polls are conditional requests and an unmodified list isn't downloaded or parsed again.
+
+    Read the updates from stream(), or pass a callback to start() to poll on a daemon thread.
+    """
+
+    QUOTE_COLUMNS = ('bid_price', 'ask_price', 'last_price', 'total_volume')
+
+    def __init__(self, markets: [Markets], interval=5, client: DataFeedClient = None):
+        """
+        Create a new poller.
+
+        :param markets: List of market identifiers listed in Markets enum.
+        :param interval: Number of seconds from the start of a poll to the start of the next one.
+        :param client: Client used for the API queries, defaults to the shared default client.
+        """
+
+        if not isinstance(markets, list) or len(markets) == 0:
+            raise ValueError('Markets must be a non-empty list')
+
+        self.markets = markets
+        self.interval = interval
+        self.client = client
+
+        # Instruments of the latest poll.
+        self.snapshot = None
+
+        self._quotes = None
+        self._etag = None
+        self._last_modified = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def poll(self) -> QuoteUpdate:
+        """
+        Poll the instrument lists once.
+
+        :return: The update, or None if the lists or the quotes in them didn't change.
+        """
+
+        headers = {}
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified is not None:
+            headers['If-Modified-Since'] = self._last_modified
+
+        poll_time = pd.Timestamp.now('UTC')
+
+        with _fetch_stock_page(*self.markets, client=self.client, headers=headers) as r:
+            if r.status_code == 304:
+                return None
+
+            self._etag = r.headers.get('ETag')
+            self._last_modified = r.headers.get('Last-Modified')
+            snapshot = _parse_stock_instruments_response(r)
+
+        update = self._compare(poll_time, snapshot)
+        return update if len(update.changed) or update.removed else None
+
+    def stream(self, max_polls: int = None):
+        """
+        Poll every interval seconds until stopped, yielding the updates.
+
+        :param max_polls: If given, stop after this many polls.
+        """
+
+        polls = 0
+
+        while not self._stop_event.is_set() and (max_polls is None or polls < max_polls):
+            start = time.monotonic()
+            update = self.poll()
+            polls += 1
+
+            if update is not None:
+                yield update
+
+            if max_polls is None or polls < max_polls:
+                self._stop_event.wait(max(0.0, self.interval - (time.monotonic() - start)))
+
+    def start(self, callback):
+        """Poll on a daemon thread, calling the callback with every update."""
+
+        if self._thread is not None and self._thread.is_alive():
+            raise RuntimeError('Poller is already running')
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(callback,), name='QuotePoller',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop polling, the stream ends after the current poll."""
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _compare(self, poll_time: pd.Timestamp, snapshot: InstrumentTable) -> QuoteUpdate:
+        """Compare the snapshot with the previous one and make it the current snapshot."""
+
+        ids = snapshot['id'].astype(str)
+        quotes = np.column_stack([snapshot[x] for x in self.QUOTE_COLUMNS])
+
+        changed = np.ones(len(ids), dtype=bool)
+        removed = []
+
+        if self.snapshot is not None and len(self.snapshot):
+            previous_ids = self.snapshot['id'].astype(str)
+            order = np.argsort(previous_ids)
+            sorted_ids = previous_ids[order]
+
+            # Match every instrument to its row in the previous snapshot.
+            positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+            found = sorted_ids[positions] == ids
+            previous_quotes = self._quotes[order[positions]]
+
+            same = (quotes == previous_quotes) | (np.isnan(quotes) & np.isnan(previous_quotes))
+            changed = ~found | ~same.all(axis=1)
+            removed = previous_ids[~np.isin(previous_ids, ids)].tolist()
+
+        self.snapshot = snapshot
+        self._quotes = quotes
+
+        return QuoteUpdate(poll_time, snapshot.select(changed), removed, snapshot)
+
+    def _run(self, callback):
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+
+            try:
+                update = self.poll()
+                if update is not None:
+                    callback(update)
+            except Exception:
+                _log.exception('Quote poll failed')
+
+            self._stop_event.wait(max(0.0, self.interval - (time.monotonic() - start)))
+
+
+class SnapshotStore:
+    """
+    Append-only store of instrument list polls, requires pyarrow.
+
+    Every recorded instrument is a row of the poll time, instrument id and the bid, ask, last price
+    and volume. Rows are buffered and written as Parquet part files into one directory per UTC
+    day. compact() merges the files of a day into one file sorted by instrument and time, whose
+    row group statistics let range queries of an instrument skip the other instruments.
+    """
+
+    COLUMNS = ('DateTime', 'id') + QuotePoller.QUOTE_COLUMNS
+
+    def __init__(self
+                 , store_dir='snapshots'
+                 , flush_rows=100_000
+                 , flush_interval=60
+                 , compression='zstd'
+                 , row_group_size=64 * 1024):
+        """
+        Create a new store, or open an existing one.
+
+        :param store_dir: Store directory, created if it doesn't exist.
+        :param flush_rows: Number of buffered rows that are written to a part file at once.
+        :param flush_interval: Maximum number of seconds rows are buffered before writing them.
+        :param compression: Parquet compression codec.
+        :param row_group_size: Number of rows per row group in compacted files.
+        """
+
+        if pyarrow is None:
+            raise ImportError('pyarrow is required for SnapshotStore')
+
+        self.store_dir = store_dir
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.row_group_size = row_group_size
+
+        self._schema = pyarrow.schema([
+            ('DateTime', pyarrow.timestamp('us', tz='UTC')),
+            ('id', pyarrow.string()),
+            *[(x, pyarrow.float64()) for x in QuotePoller.QUOTE_COLUMNS]
+        ])
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffered_rows = 0
+        self._last_flush = time.monotonic()
+
+        _create_dir_if_not_exists(store_dir)
+
+    def append(self, snapshot: InstrumentTable, poll_time: pd.Timestamp = None):
+        """
+        Record the instruments of a poll.
+
+        :param snapshot: Polled instruments, as an InstrumentTable or a list of instrument dicts.
+        :param poll_time: Time of the poll, defaults to now.
+        """
+
+        if not isinstance(snapshot, InstrumentTable):
+            snapshot = InstrumentTable.from_json_results(snapshot)
+
+        if len(snapshot) == 0:
+            return
+
+        poll_time = pd.Timestamp.now('UTC') if poll_time is None else self._to_utc(poll_time)
+
+        with self._lock:
+            self._buffer.append((poll_time, snapshot))
+            self._buffered_rows += len(snapshot)
+
+            if self._buffered_rows >= self.flush_rows or \
+                    time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def record(self, update: QuoteUpdate, changes_only=True):
+        """
+        Record a QuotePoller update, can be used as the callback of QuotePoller.start.
+
+        :param update: Update returned by the poller.
+        :param changes_only: If true, record only the changed instruments, otherwise the whole
+        snapshot of the poll.
+        """
+
+        self.append(update.changed if changes_only else update.snapshot, update.time)
+
+    def flush(self):
+        """Write the buffered rows to disk."""
+
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def query(self, instrument_ids, start_time: any = None, end_time: any = None,
+              timezone=_DEFAULT_TIMEZONE) -> pd.DataFrame:
+        """
+        Get the recorded rows of instruments in a time range.
+
+        :param instrument_ids: Instrument identifier or a list of them.
+        :param start_time: Inclusive range start as a datetime, Timestamp or ISO string, naive
+        times are in UTC. Defaults to the first recorded day.
+        :param end_time: Inclusive range end, defaults to now.
+        :param timezone: Timezone of the returned DateTime column.
+        :return: DataFrame of the rows sorted by time and instrument.
+        """
+
+        if isinstance(instrument_ids, str):
+            instrument_ids = [instrument_ids]
+
+        self.flush()
+
+        days = sorted(os.listdir(self.store_dir))
+        start = None if start_time is None else self._to_utc(start_time)
+        end = pd.Timestamp.now('UTC') if end_time is None else self._to_utc(end_time)
+
+        first_day = '' if start is None else start.date().isoformat()
+        last_day = end.date().isoformat()
+        files = [os.path.join(self.store_dir, day, x) for day in days
+                 if first_day <= day <= last_day
+                 for x in sorted(os.listdir(os.path.join(self.store_dir, day)))
+                 if x.endswith('.parquet')]
+
+        condition = pyarrow.dataset.field('id').isin(list(instrument_ids)) & \
+            (pyarrow.dataset.field('DateTime') <= end)
+        if start is not None:
+            condition &= pyarrow.dataset.field('DateTime') >= start
+
+        table = pyarrow.dataset.dataset(files, schema=self._schema, format='parquet').to_table(
+            filter=condition) if files else self._schema.empty_table()
+        values = table.to_pandas().sort_values(['DateTime', 'id'], ignore_index=True)
+        values['DateTime'] = values['DateTime'].dt.tz_convert(timezone)
+
+        return values
+
+    def compact(self, day: any):
+        """
+        Merge the part files of a day into one file sorted by instrument and time.
+
+        :param day: The UTC day as a date or ISO date string.
+        """
+
+        day = day if isinstance(day, str) else day.isoformat()
+        day_dir = os.path.join(self.store_dir, day)
+
+        self.flush()
 
-        cached_instruments_full_path = os.path.join(_DEFAULT_CACHE_DIR, cached_instruments_filename)
+        files = sorted(x for x in os.listdir(day_dir) if x.endswith('.parquet'))
+        if len(files) < 2:
+            return
 
-        with open(cached_instruments_full_path, 'wb+') as f:
-            pickle.dump(instruments, f)
+        table = pyarrow.dataset.dataset([os.path.join(day_dir, x) for x in files],
+                                        schema=self._schema, format='parquet').to_table()
+        table = table.sort_by([('id', 'ascending'), ('DateTime', 'ascending')])
 
-    # Return dict or convert the dicts into MarketInstrument objects.
-    return instruments if return_dict else [MarketInstrument.from_json_result(x) for x in
-                                            instruments]
+        compacted_path = os.path.join(day_dir, f'compacted-{time.time_ns()}.parquet')
+        _write_atomic(compacted_path, lambda path: pyarrow.parquet.write_table(
+            table, path, compression=self.compression, row_group_size=self.row_group_size))
+
+        for file_name in files:
+            os.remove(os.path.join(day_dir, file_name))
+
+    @staticmethod
+    def _to_utc(value) -> pd.Timestamp:
+        value = pd.Timestamp(value)
+        return value.tz_localize('UTC') if value.tz is None else value.tz_convert('UTC')
+
+    def _flush(self):
+        if not self._buffer:
+            return
+
+        buffer, self._buffer = self._buffer, []
+        self._buffered_rows = 0
+        self._last_flush = time.monotonic()
+
+        # Write the rows of every UTC day to its own part file.
+        days = defaultdict(list)
+        for poll_time, snapshot in buffer:
+            days[poll_time.date().isoformat()].append((poll_time, snapshot))
+
+        for day, polls in days.items():
+            day_dir = os.path.join(self.store_dir, day)
+            _create_dir_if_not_exists(day_dir)
+
+            # Poll times in microseconds since the epoch.
+            times = np.concatenate([np.full(len(x), t.value // 1000, dtype=np.int64)
+                                    for t, x in polls])
+            columns = {
+                'DateTime': pyarrow.array(times, type=self._schema.field('DateTime').type),
+                'id'      : pyarrow.array(np.concatenate([x['id'] for t, x in polls]),
+                                          type=pyarrow.string())
+            }
+            for column in QuotePoller.QUOTE_COLUMNS:
+                columns[column] = np.concatenate([x[column] for t, x in polls])
+
+            table = pyarrow.table(columns, schema=self._schema)
+            part_path = os.path.join(day_dir, f'part-{time.time_ns()}-{os.getpid()}.parquet')
+            _write_atomic(part_path, lambda path: pyarrow.parquet.write_table(
+                table, path, compression=self.compression))